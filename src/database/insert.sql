@@ -8,6 +8,7 @@ CREATE TABLE IF NOT EXISTS public.site (
 	name varchar(60) not null,
 	description varchar(100),
 
+	CONSTRAINT site_name_key UNIQUE (name),
 	PRIMARY KEY (id)
 );
 
@@ -18,7 +19,7 @@ CREATE TABLE IF NOT EXISTS public.drone_acquisition (
 	lon float not null,
 	time timestamp not null,
 	site int,
-	coords public.geometry,
+	coords public.geometry(Point,3003),
 	gamma float[],
 	start_acq_time timestamp not null,
 	stop_acq_time timestamp not null,
@@ -132,7 +133,7 @@ CREATE TABLE IF NOT EXISTS public.lab_acquisition (
 	nfield varchar(50) not null,
 	depth varchar(50) not null,
 	site int,
-	coords public.geometry,
+	coords public.geometry(Point,3003),
 	hyperspectral float[] not null,
 	gamma float[],
 
@@ -177,11 +178,54 @@ CREATE TABLE IF NOT EXISTS public.raster_master (
 	table_name varchar(60) not null,
 	description varchar(100),
 	visible boolean DEFAULT true,
+	version int not null DEFAULT 1,
 
 	PRIMARY KEY (id)
 );
 
 
+CREATE TABLE IF NOT EXISTS public.vector_master (
+	id serial not null,
+	layer_name varchar(60) not null,
+	table_name varchar(60) not null,
+	source varchar(200),
+	geometry_type varchar(30),
+	features bigint,
+	visible boolean DEFAULT true,
+
+	CONSTRAINT vector_master_table_name_key UNIQUE (table_name),
+	PRIMARY KEY (id)
+);
+
+
+CREATE TABLE IF NOT EXISTS public.raster_stats (
+	table_name varchar(60) not null,
+	version varchar(60) not null,
+	min float not null,
+	max float not null,
+	count bigint not null,
+	histogram bigint[] not null,
+	num_classes int not null,
+	breaks float[] not null,
+	updated timestamp not null DEFAULT now(),
+
+	PRIMARY KEY (table_name)
+);
+
+
+
+-- indexes on the columns joined by the layer views and looked up by the ingestion,
+-- kept in sync with pignoletto/migrations.py
+CREATE INDEX IF NOT EXISTS drone_acquisition_coords_idx ON public.drone_acquisition USING GIST (coords);
+CREATE INDEX IF NOT EXISTS lab_acquisition_coords_idx ON public.lab_acquisition USING GIST (coords);
+CREATE INDEX IF NOT EXISTS drone_acquisition_site_idx ON public.drone_acquisition (site);
+CREATE INDEX IF NOT EXISTS lab_acquisition_site_idx ON public.lab_acquisition (site);
+CREATE INDEX IF NOT EXISTS estimation_drone_acquisition_idx ON public.estimation (drone_acquisition);
+CREATE INDEX IF NOT EXISTS estimation_model_idx ON public.estimation (model);
+CREATE INDEX IF NOT EXISTS measure_id_variable_idx ON public.measure (id_variable);
+CREATE INDEX IF NOT EXISTS estimated_value_id_variable_idx ON public.estimated_value (id_variable);
+
+
 
 CREATE TABLE IF NOT EXISTS public.role (
 	id serial NOT NULL,
@@ -242,6 +286,7 @@ VALUES
 	(3, 'sito3', ''),
 	(4, 'sito4', ''),
 	(5, 'sito5', '');
+SELECT setval(pg_get_serial_sequence('public.site', 'id'), (SELECT max(id) FROM public.site));
 
 
 
@@ -70,9 +70,21 @@ class ChangeRasterColor(QgsProcessingAlgorithm):
 
         color_ramp = QgsStyle().defaultStyle().colorRamp(self.color_names[int(color)])
 
-        renderer = QgsSingleBandPseudoColorRenderer(layer.dataProvider(), 1)
-        renderer.createShader(color_ramp, colorRampType=QgsColorRampShader.Interpolated, 
-            classificationMode=QgsColorRampShader.Quantile, classes=100)
+        old_renderer = layer.renderer()
+        old_shader = old_renderer.shader() if isinstance(old_renderer, QgsSingleBandPseudoColorRenderer) else None
+        if old_shader is not None and old_shader.rasterShaderFunction().colorRampItemList():
+            # keep the classes of the layer, only the colors change
+            renderer = old_renderer.clone()
+            ramp_shader = renderer.shader().rasterShaderFunction()
+            items = ramp_shader.colorRampItemList()
+            for i, item in enumerate(items):
+                item.color = color_ramp.color(i / max(len(items) - 1, 1))
+            ramp_shader.setSourceColorRamp(color_ramp.clone())
+            ramp_shader.setColorRampItemList(items)
+        else:
+            renderer = QgsSingleBandPseudoColorRenderer(layer.dataProvider(), 1)
+            renderer.createShader(color_ramp, colorRampType=QgsColorRampShader.Interpolated, 
+                classificationMode=QgsColorRampShader.Quantile, classes=100)
         layer.setRenderer(renderer)
 
         layer.triggerRepaint()
@@ -146,9 +146,9 @@ class IdwInterpolation(QgsProcessingAlgorithm):
         columns = self.parameterAsInt(parameters, self.COLUMNS, context)
         rows = self.parameterAsInt(parameters, self.ROWS, context)
         if columns == 0:
-            columns = max(math.ceil(height / pixel_size), 1)
+            columns = max(math.ceil(width / pixel_size), 1)
         if rows == 0:
-            rows = max(math.ceil(width / pixel_size), 1)
+            rows = max(math.ceil(height / pixel_size), 1)
 
         layer_data = QgsInterpolator.LayerData()
         layer_data.source = source
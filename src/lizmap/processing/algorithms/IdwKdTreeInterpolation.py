@@ -0,0 +1,227 @@
+import importlib.util
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from osgeo import gdal
+
+from qgis.core import (QgsProcessing,
+                       QgsProcessingParameterNumber,
+                       QgsProcessingParameterFeatureSource,
+                       QgsProcessingParameterDefinition,
+                       QgsProcessingParameterRasterDestination,
+                       QgsProcessingParameterExtent,
+                       QgsProcessingParameterField,
+                       QgsProcessingException,
+                       QgsProcessingAlgorithm,
+                       QgsFeatureRequest)
+from qgis.PyQt.QtCore import QCoreApplication
+
+# each task evaluates a strip of rows as high as the GeoTIFF blocks, so that it writes whole tiles,
+# in chunks of at most CHUNK_CELLS cells to bound the memory of the neighbour arrays
+BLOCK_SIZE = 256
+CHUNK_CELLS = 65536
+NODATA = -9999.0
+
+# the KD-tree of the points, built once in each worker process
+_grid = {}
+
+
+def init_grid(points, values, power, neighbours, radius, x_min, y_max, pixel_size, columns):
+    from scipy.spatial import cKDTree
+    _grid.update(tree=cKDTree(points), values=values, power=power, neighbours=min(neighbours, len(values)),
+                 radius=radius if radius > 0 else np.inf, x_min=x_min, y_max=y_max, pixel_size=pixel_size,
+                 columns=columns)
+
+
+def interpolate_rows(first_row, num_rows):
+    """Interpolates the cells of num_rows rows of the grid, from first_row, at their centres.
+    Each cell is the inverse distance weighted mean of its nearest points within the radius,
+    the value of a point if it lies on the centre, NODATA if no point is near enough.
+    """
+    g = _grid
+    xs = g['x_min'] + (np.arange(g['columns']) + 0.5) * g['pixel_size']
+    ys = g['y_max'] - (np.arange(first_row, first_row + num_rows) + 0.5) * g['pixel_size']
+    centres = np.column_stack([np.tile(xs, num_rows), np.repeat(ys, g['columns'])])
+    result = np.empty(len(centres), dtype=np.float32)
+    for start in range(0, len(centres), CHUNK_CELLS):
+        result[start:start + CHUNK_CELLS] = idw(centres[start:start + CHUNK_CELLS])
+    return first_row, result.reshape(num_rows, g['columns'])
+
+
+def idw(centres):
+    g = _grid
+    dist, idx = g['tree'].query(centres, k=g['neighbours'], distance_upper_bound=g['radius'])
+    if g['neighbours'] == 1:
+        dist, idx = dist[:, None], idx[:, None]
+    # missing neighbours have an infinite distance and the index len(values)
+    valid = idx < len(g['values'])
+    exact = valid & (dist == 0)
+    weights = np.zeros(dist.shape)
+    np.power(dist, -g['power'], out=weights, where=valid & ~exact)
+    has_exact = exact.any(axis=1)
+    weights[has_exact] = exact[has_exact]
+    total = weights.sum(axis=1)
+    values = g['values'][np.where(valid, idx, 0)]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = (weights * values).sum(axis=1) / total
+    result[total == 0] = NODATA
+    return result
+
+
+class IdwKdTreeInterpolation(QgsProcessingAlgorithm):
+    INPUT = 'INPUT'
+    FIELD = 'FIELD'
+    POWER = 'POWER'
+    NEIGHBOURS = 'NEIGHBOURS'
+    RADIUS = 'RADIUS'
+    PIXEL_SIZE = 'PIXEL_SIZE'
+    EXTENT = 'EXTENT'
+    WORKERS = 'WORKERS'
+    OUTPUT = 'OUTPUT'
+
+    def tr(self, string, context=''):
+        if context == '':
+            context = self.__class__.__name__
+        return QCoreApplication.translate(context, string)
+
+    def __init__(self):
+        super().__init__()
+
+    def createInstance(self, config={}):
+        return self.__class__()
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(QgsProcessingParameterFeatureSource(self.INPUT,
+                                                              self.tr('Input layer'),
+                                                              [QgsProcessing.SourceType.TypeVectorPoint]))
+        self.addParameter(QgsProcessingParameterField(self.FIELD,
+                                                      self.tr('Interpolation attribute field'),
+                                                      None,
+                                                      self.INPUT,
+                                                      QgsProcessingParameterField.DataType.Numeric))
+        self.addParameter(QgsProcessingParameterNumber(self.POWER,
+                                                       self.tr('Distance coefficient P'),
+                                                       type=QgsProcessingParameterNumber.Type.Double,
+                                                       minValue=0.0, maxValue=99.99, defaultValue=2.0))
+        self.addParameter(QgsProcessingParameterNumber(self.NEIGHBOURS,
+                                                       self.tr('Maximum number of neighbours'),
+                                                       type=QgsProcessingParameterNumber.Type.Integer,
+                                                       minValue=1, defaultValue=12))
+        self.addParameter(QgsProcessingParameterNumber(self.RADIUS,
+                                                       self.tr('Search radius (0 for no limit)'),
+                                                       type=QgsProcessingParameterNumber.Type.Double,
+                                                       minValue=0.0, defaultValue=0.0))
+        self.addParameter(QgsProcessingParameterNumber(self.PIXEL_SIZE,
+                                                       self.tr('Pixel size'),
+                                                       type=QgsProcessingParameterNumber.Type.Double,
+                                                       minValue=0.0, defaultValue=1.0))
+        self.addParameter(QgsProcessingParameterExtent(self.EXTENT,
+                                                       self.tr('Extent'),
+                                                       optional=True))
+        workers_param = QgsProcessingParameterNumber(self.WORKERS,
+                                                     self.tr('Worker processes (0 for one per CPU)'),
+                                                     type=QgsProcessingParameterNumber.Type.Integer,
+                                                     minValue=0, defaultValue=0)
+        workers_param.setFlags(workers_param.flags() | QgsProcessingParameterDefinition.Flag.FlagAdvanced)
+        self.addParameter(workers_param)
+        self.addParameter(QgsProcessingParameterRasterDestination(self.OUTPUT,
+                                                                  self.tr('Interpolated')))
+
+    def name(self):
+        return 'idwkdtreeinterpolation'
+
+    def displayName(self):
+        return self.tr('IDW interpolation (nearest neighbours)')
+
+    def processAlgorithm(self, parameters, context, feedback):
+        source = self.parameterAsSource(parameters, self.INPUT, context)
+        if source is None:
+            raise QgsProcessingException(self.invalidSourceError(parameters, self.INPUT))
+        field = self.parameterAsString(parameters, self.FIELD, context)
+        power = self.parameterAsDouble(parameters, self.POWER, context)
+        neighbours = self.parameterAsInt(parameters, self.NEIGHBOURS, context)
+        radius = self.parameterAsDouble(parameters, self.RADIUS, context)
+        pixel_size = self.parameterAsDouble(parameters, self.PIXEL_SIZE, context)
+        workers = self.parameterAsInt(parameters, self.WORKERS, context) or multiprocessing.cpu_count()
+        output = self.parameterAsOutputLayer(parameters, self.OUTPUT, context)
+        if pixel_size <= 0:
+            raise QgsProcessingException(self.tr('Pixel size must be greater than 0'))
+        if importlib.util.find_spec('scipy') is None:
+            raise QgsProcessingException(self.tr('SciPy is required by this algorithm'))
+
+        # points with a value
+        field_index = source.fields().lookupField(field)
+        request = QgsFeatureRequest().setSubsetOfAttributes([field_index])
+        points, values = [], []
+        for feature in source.getFeatures(request):
+            value = feature.attributes()[field_index]
+            if feature.hasGeometry() and value is not None:
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    continue
+                if math.isfinite(value):
+                    for point in feature.geometry().vertices():
+                        points.append((point.x(), point.y()))
+                        values.append(value)
+        if not values:
+            raise QgsProcessingException(self.tr('No points with a value to interpolate'))
+        points = np.array(points, dtype=np.float64)
+        values = np.array(values, dtype=np.float64)
+
+        # the grid covers the extent with whole pixels, from its upper left corner
+        extent = self.parameterAsExtent(parameters, self.EXTENT, context, source.sourceCrs())
+        if extent is None or extent.isNull() or extent.isEmpty():
+            extent = source.sourceExtent()
+        columns = max(math.ceil(extent.width() / pixel_size), 1)
+        rows = max(math.ceil(extent.height() / pixel_size), 1)
+        x_min, y_max = extent.xMinimum(), extent.yMaximum()
+        feedback.pushInfo(self.tr('{} points, grid of {} columns and {} rows').format(len(values), columns, rows))
+
+        dataset = gdal.GetDriverByName('GTiff').Create(
+            output, columns, rows, 1, gdal.GDT_Float32,
+            ['TILED=YES', f'BLOCKXSIZE={BLOCK_SIZE}', f'BLOCKYSIZE={BLOCK_SIZE}', 'COMPRESS=DEFLATE',
+             'PREDICTOR=3', 'BIGTIFF=IF_SAFER'])
+        if dataset is None:
+            raise QgsProcessingException(self.tr('Could not create {}').format(output))
+        dataset.SetGeoTransform((x_min, pixel_size, 0, y_max, 0, -pixel_size))
+        dataset.SetProjection(source.sourceCrs().toWkt())
+        band = dataset.GetRasterBand(1)
+        band.SetNoDataValue(NODATA)
+
+        strips = [(first_row, min(BLOCK_SIZE, rows - first_row)) for first_row in range(0, rows, BLOCK_SIZE)]
+        grid = (points, values, power, neighbours, radius, x_min, y_max, pixel_size, columns)
+        executor = None
+        if workers == 1 or len(strips) == 1:
+            init_grid(*grid)
+            results = (interpolate_rows(*cur_strip) for cur_strip in strips)
+        else:
+            # forked workers inherit the points, each builds its own tree once
+            executor = ProcessPoolExecutor(max_workers=min(workers, len(strips)),
+                                           mp_context=multiprocessing.get_context('fork'),
+                                           initializer=init_grid, initargs=grid)
+            futures = [executor.submit(interpolate_rows, *cur_strip) for cur_strip in strips]
+            results = (future.result() for future in futures)
+        canceled = False
+        try:
+            for done, (first_row, block) in enumerate(results, 1):
+                if feedback.isCanceled():
+                    canceled = True
+                    break
+                band.WriteArray(block, 0, first_row)
+                feedback.setProgress(100 * done / len(strips))
+        finally:
+            if executor is not None:
+                for future in futures:
+                    future.cancel()
+                executor.shutdown(wait=True)
+            band.FlushCache()
+            band = None
+            dataset = None
+        if canceled:
+            # do not leave a partially interpolated raster behind
+            gdal.GetDriverByName('GTiff').Delete(output)
+            raise QgsProcessingException(self.tr('Interpolation canceled'))
+        return {self.OUTPUT: output}
@@ -1,12 +1,22 @@
 import pandas as pd
 import numpy as np
 from collections import OrderedDict
-from datetime import datetime
-from tqdm import tqdm
+import io
 import os
+import re
+import math
+import json
+import shutil
+import tempfile
+import subprocess
+import zipfile
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from .models import (
     CreateView, 
+    DropView,
     variable, 
     measure, 
     lab_acq, 
@@ -16,11 +26,17 @@ from .models import (
     estimated_value, 
     variable_unique,
     drone_acq,
-    raster_master
+    raster_master,
+    vector_master
 )
-from pignoletto import engine, db
+from .readers import (
+    decode_pg_arrays,
+    parse_pg_arrays,
+    read_chunks,
+    to_pg_arrays
+)
+from pignoletto import app, engine, db
 import sqlalchemy as sa
-from geoalchemy2 import func
 
 
 def is_float(element):
@@ -31,20 +47,262 @@ def is_float(element):
         return False
 
 
+
+def copy_from_frame(cursor, df, table, columns):
+    """Streams the given columns of a DataFrame into a table through PostgreSQL COPY."""
+    buffer = io.StringIO()
+    df.to_csv(buffer, columns=columns, header=False, index=False)
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+# materialized view holding the measures of each lab acquisition pivoted into columns
+LAB_PIVOT = 'lab_acquisition_pivot'
+# table caching the statistics and the colour ramp classification of each raster
+RASTER_STATS = 'raster_stats'
+# lifts STATEMENT_TIMEOUT for the rest of a maintenance transaction (refreshes, DDL, raster statistics)
+NO_STATEMENT_TIMEOUT = sa.text('SET LOCAL statement_timeout = 0')
+# name of a table created by the import tools, quoted neither by them nor by us
+TABLE_NAME_PATTERN = r'[a-z_][a-z0-9_]{0,52}'
+
+
+def pg_env():
+    """Environment of the PostgreSQL command line tools (e.g. psql), connecting them to the database
+    of the engine. The password is passed in the environment, not on the command line.
+    """
+    env = dict(os.environ)
+    url = engine.url
+    for key, value in (('PGHOST', url.host), ('PGPORT', url.port), ('PGUSER', url.username),
+                       ('PGPASSWORD', url.password), ('PGDATABASE', url.database)):
+        if value is not None:
+            env[key] = str(value)
+    return env
+
+
+def run_tool(args, **kwargs):
+    """Runs a command line tool without a shell, raising RuntimeError with its error output if it fails.
+
+    Returns
+    -------
+    bytes : the standard output of the tool
+    """
+    completed = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+    if completed.returncode != 0:
+        raise RuntimeError(f"{args[0]} failed: {completed.stderr.decode(errors='replace').strip()}")
+    return completed.stdout
+
+
+def tool_error(name, log_path):
+    """Builds the error of a failed tool from the last lines of its log."""
+    with open(log_path, 'rb') as f:
+        lines = f.read().decode(errors='replace').strip().splitlines()
+    return RuntimeError(f"{name} failed: {' '.join(lines[-5:])}")
+
+
+def raster_size(raster_fn):
+    """Gets the width and height, in pixels, of a raster file."""
+    info = json.loads(run_tool(['gdalinfo', '-json', raster_fn]))
+    return tuple(info['size'])
+
+
+# candidate tile sizes of the loaded rasters and the maximum number of full resolution tiles
+RASTER_TILE_SIZES = (256, 512, 1024)
+RASTER_MAX_TILES = 10000
+
+
+def raster_tile_size(width, height):
+    """Chooses the tile size of a raster: the smallest candidate keeping the full resolution tiles within
+    RASTER_MAX_TILES, cut to the raster size so that a small raster is a single tile.
+
+    Returns
+    -------
+    tuple : tile width and height
+    """
+    for size in RASTER_TILE_SIZES:
+        if math.ceil(width / size) * math.ceil(height / size) <= RASTER_MAX_TILES:
+            break
+    return min(size, width), min(size, height)
+
+
+def overview_factors(width, height, tile_size):
+    """Gets the overview factors of a raster (2, 4, 8, ...), down to the first overview fitting in a tile."""
+    factors = []
+    factor = 2
+    while max(math.ceil(width / tile_size[0]), math.ceil(height / tile_size[1])) * 2 > factor:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def count_tiles(width, height, tile_size, factors):
+    """Counts the tiles of a raster and of its overviews."""
+    return sum(math.ceil(math.ceil(width / factor) / tile_size[0]) * math.ceil(math.ceil(height / factor) / tile_size[1])
+               for factor in [1] + factors)
+
+
+# vector formats imported from a file or from a zip of them
+VECTOR_EXTENSIONS = ('gpkg', 'shp')
+
+
+# directory of work_dir where the members of a zip are extracted
+VECTOR_SOURCES_DIR = 'sources'
+
+
+def extract_vector_sources(path, work_dir):
+    """Gets the vector files of a GeoPackage, a shapefile or a zip of them, extracted in work_dir.
+    The members of a zip keep their directories, so that files with the same name in different
+    directories (e.g. a/roads.shp and b/roads.shp, with their .dbf and .shx) do not overwrite each other.
+    Hidden members and members with '..' in their path are skipped.
+
+    Returns
+    -------
+    list : the paths of the vector files
+    """
+    if not zipfile.is_zipfile(path):
+        return [path]
+    sources = []
+    sources_dir = os.path.join(work_dir, VECTOR_SOURCES_DIR)
+    with zipfile.ZipFile(path) as archive:
+        for member in archive.infolist():
+            parts = [part for part in member.filename.replace('\\', '/').split('/') if part not in ('', '.')]
+            if member.is_dir() or not parts or any(part == '..' or part.startswith('.') or ':' in part 
+                                                   for part in parts):
+                continue
+            target = os.path.join(sources_dir, *parts)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with archive.open(member) as src, open(target, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            if parts[-1].rsplit('.', 1)[-1].lower() in VECTOR_EXTENSIONS:
+                sources.append(target)
+    return sorted(sources)
+
+
+def vector_source_name(source, work_dir):
+    """Gets the name of a vector file: its path within the zip it was extracted from, else its file name."""
+    sources_dir = os.path.join(work_dir, VECTOR_SOURCES_DIR)
+    if os.path.commonpath([os.path.abspath(source), os.path.abspath(sources_dir)]) == os.path.abspath(sources_dir):
+        return os.path.relpath(source, sources_dir).replace(os.sep, '/')
+    return os.path.basename(source)
+
+
+def list_vector_layers(source):
+    """Lists the layers of a vector file, reading its metadata only.
+
+    Returns
+    -------
+    list : a dict with name, geometry type, feature count and EPSG code (None if unknown) of each layer
+    """
+    from osgeo import ogr
+    dataset = ogr.Open(source)
+    if dataset is None:
+        raise ValueError(f"{os.path.basename(source)} is not a valid vector file.")
+    layers = []
+    for i in range(dataset.GetLayerCount()):
+        layer = dataset.GetLayerByIndex(i)
+        srs = layer.GetSpatialRef()
+        layers.append({
+            'name': layer.GetName(),
+            'geometry_type': ogr.GeometryTypeToName(layer.GetGeomType()),
+            'features': layer.GetFeatureCount(),
+            'epsg': None if srs is None else srs.GetAuthorityCode(None)
+        })
+    return layers
+
+
+def vector_table_name(layer_name, taken):
+    """Builds the table name of a vector layer (vector_<layer name>, lowercase), unique among taken."""
+    base = 'vector_' + (re.sub(r'[^a-z0-9_]+', '_', layer_name.lower()).strip('_') or 'layer')
+    base = base[:53]
+    table_name = base
+    i = 1
+    while table_name in taken:
+        i += 1
+        table_name = f'{base}_{i}'
+    taken.add(table_name)
+    return table_name
+
+
 class DBManager(object):
     def __init__(self):
         # initialize variable containing the views
         self.views = OrderedDict({'lab_acquisition':OrderedDict(), 'estimated':OrderedDict()})
+        # site name -> id of the committed sites, shared by all the requests of the process
+        self.site_ids = {}
+        # columns of the lab pivot and whether drone acquisitions exist, used to render the tables,
+        # None when unknown
+        self.lab_pivot_columns = None
+        self.drone_acquisitions_exist = None
+        # tables changed by the deletions, whose views are refreshed in background (see schedule_refresh)
+        self.refresh_tables = set()
+        self.refresh_timer = None
+        self.refresh_pid = None
+        self.refresh_lock = threading.Lock()
+        # sites inserted by a transaction are cached only once it is committed
+        sa.event.listen(db.session, 'after_commit', self._commit_site_ids)
+        sa.event.listen(db.session, 'after_rollback', self._rollback_site_ids)
 
 
     def get_views(self): 
         return self.views
 
 
+    def get_site_ids(self, names):
+        """Gets the ids of the given site names, inserting the missing sites. Known sites are
+        served from the cache, the others are resolved with a single upsert.
+
+        Returns
+        -------
+        dict : site name -> site id
+        """
+        pending = db.session.info.setdefault('site_ids', {})
+        names = {str(name) for name in names}
+        ids = {name: self.site_ids.get(name, pending.get(name)) for name in names}
+        missing = [name for name, site_id in ids.items() if site_id is None]
+        if missing:
+            # new sites are returned by the insert, existing ones by the select
+            rows = db.session.execute(sa.text('''
+                WITH inserted AS (
+                    INSERT INTO site (name) SELECT unnest(CAST(:names AS varchar[]))
+                    ON CONFLICT (name) DO NOTHING
+                    RETURNING name, id
+                )
+                SELECT name, id, true FROM inserted
+                UNION ALL
+                SELECT name, id, false FROM site WHERE name = ANY(CAST(:names AS varchar[]))
+            '''), {'names': missing}).all()
+            # sites committed by a concurrent transaction after the statement started
+            found = {name for name, _, _ in rows}
+            if len(found) < len(missing):
+                rows += [(name, site_id, False) for name, site_id in db.session.execute(
+                    sa.text('SELECT name, id FROM site WHERE name = ANY(CAST(:names AS varchar[]))'),
+                    {'names': [name for name in missing if name not in found]}).all()]
+            for name, site_id, is_new in rows:
+                ids[name] = site_id
+                if is_new:
+                    pending[name] = site_id
+                else:
+                    self.site_ids[name] = site_id
+        return ids
+
+
+    def invalidate_site_ids(self):
+        """Empties the site cache, to be called when sites are deleted or renamed."""
+        self.site_ids.clear()
+
+
+    def _commit_site_ids(self, session):
+        self.site_ids.update(session.info.pop('site_ids', {}))
+
+
+    def _rollback_site_ids(self, session):
+        session.info.pop('site_ids', None)
+
+
     def delete_all_lab_acquisition(self):
         db.session.query(measure).delete()
         db.session.query(lab_acq).delete()
         db.session.commit()
+        self.schedule_refresh(['measure', 'lab_acquisition'])
 
 
     def delete_lab_acquisition(self, lab_id):
@@ -53,6 +311,7 @@ class DBManager(object):
         # delete from acquisition
         db.session.query(lab_acq).filter(lab_acq.c.id == lab_id).delete()
         db.session.commit()
+        self.schedule_refresh(['measure', 'lab_acquisition'])
 
 
     def delete_drone_acquisition(self, da_id):
@@ -62,14 +321,67 @@ class DBManager(object):
         # delete from estimation
         db.session.query(estimation).filter(estimation.c.id == da_id).delete()
         db.session.commit()
+        self.schedule_refresh(['estimated_value', 'estimation'])
 
     
     def delete_from_drone_acquisition(self, da_id):
         db.session.query(drone_acq).filter(drone_acq.c.id == da_id).delete()
         db.session.commit()
+        self.drone_acquisitions_exist = None
+        self.schedule_refresh(['drone_acquisition'])
 
 
-    def insert_lab_acquisition(self, csv, sep=','):
+    def schedule_refresh(self, tables):
+        """Refreshes in background the lab pivot and the materialized layer views which depend on the
+        given tables. The refresh is delayed by VIEW_REFRESH_DELAY seconds, so that the deletions
+        made meanwhile are refreshed at once, and the requests deleting do not wait for it.
+        """
+        with self.refresh_lock:
+            self.refresh_tables.update(tables)
+            # the timer thread does not survive a fork, e.g. of the uWSGI workers
+            if self.refresh_timer is not None and self.refresh_pid == os.getpid():
+                return
+            self.refresh_timer = threading.Timer(app.config.get("VIEW_REFRESH_DELAY", 5), self._run_refresh)
+            self.refresh_timer.daemon = True
+            self.refresh_pid = os.getpid()
+            self.refresh_timer.start()
+
+
+    def _run_refresh(self):
+        with self.refresh_lock:
+            tables = sorted(self.refresh_tables)
+            self.refresh_tables.clear()
+            self.refresh_timer = None
+        try:
+            with app.app_context():
+                try:
+                    if {'measure', 'lab_acquisition'} & set(tables):
+                        self.refresh_lab_pivot()
+                    self.refresh_layer_views('lab_', tables)
+                    self.refresh_layer_views('est_', tables)
+                finally:
+                    db.session.remove()
+        except Exception:
+            traceback.print_exc()
+
+
+    def insert_lab_acquisition(self, csv, sep=',', chunk_size=None, progress=None, file_format='csv'):
+        report = {'chunks': 0, 'rows_read': 0, 'inserted': 0}
+        # read file in chunks, writing each of them as it arrives
+        for df in read_chunks(csv, file_format=file_format, sep=sep, chunk_size=chunk_size):
+            report['inserted'] += self.insert_lab_frame(df)
+            report['chunks'] += 1
+            report['rows_read'] += len(df)
+            if progress is not None:
+                progress(report)
+        # update the pivoted acquisitions and the layers once the whole file is in
+        self.refresh_lab_pivot()
+        self.refresh_layer_views('lab_')
+        # return the outcome of the ingestion
+        return report
+
+
+    def insert_lab_frame(self, df):
         # define mapping between variables names
         header_mapping = {
             'ID': 'id',
@@ -92,77 +404,190 @@ class DBManager(object):
             'Cesio Bq/kg': 'Cesio',
         }
 
-        # read file
-        df = pd.read_csv(csv, sep=sep)
-
         # check that the variables in the csv are contained in the dataset
         for key in header_mapping:
             if not key in df.columns:
                 raise ValueError(f'Variable {key} not present in CSV file.')
 
         # convert headers
-        new_cols = []
-        for i in range(len(df.columns)):
-            if df.columns[i] in header_mapping:
-                new_cols.append(header_mapping[df.columns[i]])
-            else:
-                new_cols.append(df.columns[i])
-        df.columns = new_cols
+        df = df.rename(columns=header_mapping)
 
         # get headers of hyperspectral signal
         hyper_headers = [col for col in df.columns if is_float(col)]
 
-        # get all sites
-        cur_sites = list(df['site'].unique())
+        # an ID appearing more than once is replaced by its last occurrence
+        df = df.drop_duplicates(subset='id', keep='last')
 
-        # insert them if not present
-        for cur_site in cur_sites:
-            res = db.session.query(site).filter(site.c.name == cur_site).first()
-            if res is None:
-                s = site.insert().values(name=cur_site)
-                db.session.execute(s)
-
-        # get site ids
-        site_mapping = dict(db.session.query(site.c.name, site.c.id).all())
+        # get site ids, inserting the new sites
+        site_names = df['site'].dropna().astype(str)
+        site_mapping = self.get_site_ids(site_names.unique())
 
         # get variables ids
         var_mapping = dict(db.session.query(variable.c.name, variable.c.id).all())
 
-        # for each sample
-        for i in range(len(df)):
-            # get it
-            cur_sample = df.iloc[i]
-            # get hyperspectral signal
-            cur_hyper = cur_sample[hyper_headers].tolist()
-            # create acquisition
-            cur_id, cur_lat, cur_lon, cur_nlab, cur_nfield, cur_depth, cur_site = \
-                  cur_sample[['id','lat','lon','nlab','nfield','depth', 'site']]
-            cur_site_id = site_mapping[cur_site]
-            # define current time stamp
-            cur_time = datetime.now()
-            # delete acquisition from db
-            self.delete_lab_acquisition(cur_id)
-            
-            # perform insert query
-            q = lab_acq.insert().values(id=cur_id, lat=cur_lat, lon=cur_lon, time=cur_time, hyperspectral=cur_hyper,\
-                        nlab=cur_nlab, nfield= cur_nfield, depth=cur_depth, site=cur_site_id,\
-                        coords=func.ST_GeomFromText(f"POINT({cur_lon} {cur_lat})", 3003))
-            db.session.execute(q)
-
-            # for each var add its measure
-            for cur_var in ['pH_H2O', 'CaCO3', 'OC', 'N', 'Sabbia', 'Limo', 'Argilla', 'Torio', 'Radio', 'Potassio', 'Cesio']:
-                cur_var_id = var_mapping[cur_var]
-                cur_var_val = cur_sample[cur_var]
-                # TODO: in future do not accept nan or non-float values
-                if cur_var_val == 'n.d.': continue
-                cur_var_val = float(cur_var_val)
-                q = measure.insert().values(id_lab_acquisition=cur_id, id_variable=cur_var_id, value=cur_var_val)
-                if not is_float(cur_var_val) or np.isnan(cur_var_val): continue
-                db.session.execute(q)
+        # build the acquisitions, with the hyperspectral signal as array literal
+        acquisitions = df[['id', 'lat', 'lon', 'nlab', 'nfield', 'depth']].copy()
+        acquisitions['site'] = site_names.map(site_mapping).reindex(df.index).astype('Int64')
+        if 'hyperspectral' in df.columns:
+            # a list column, e.g. from Parquet/Arrow
+            hyperspectral, valid_hyper = parse_pg_arrays(df['hyperspectral'])
+            if not valid_hyper.all():
+                raise ValueError(f"Hyperspectral signal not valid for ID {df['id'][~valid_hyper].iloc[0]}.")
+            acquisitions['hyperspectral'] = hyperspectral
+        else:
+            acquisitions['hyperspectral'] = to_pg_arrays(df[hyper_headers].to_numpy(dtype=float))
+
+        # build the measures in long format, dropping missing (e.g. 'n.d.') and non-float values
+        lab_vars = ['pH_H2O', 'CaCO3', 'OC', 'N', 'Sabbia', 'Limo', 'Argilla', 'Torio', 'Radio', 'Potassio', 'Cesio']
+        measures = df.melt(id_vars='id', value_vars=lab_vars, var_name='variable', value_name='value')
+        measures['value'] = pd.to_numeric(measures['value'], errors='coerce')
+        measures = measures.dropna(subset=['value'])
+        measures['id_variable'] = measures['variable'].map(var_mapping)
+        measures = measures.rename(columns={'id': 'id_lab_acquisition'})
+
+        # work on the DBAPI connection of the session, so that everything runs in one transaction
+        cursor = db.session.connection().connection.cursor()
+        # stage acquisitions
+        cursor.execute('''
+            CREATE TEMP TABLE tmp_lab_acquisition (
+                id varchar(20), lat float, lon float, nlab varchar(50), nfield varchar(50),
+                depth varchar(50), site int, hyperspectral float[]
+            ) ON COMMIT DROP;
+        ''')
+        copy_from_frame(cursor, acquisitions, 'tmp_lab_acquisition', list(acquisitions.columns))
+        # delete the acquisitions which are going to be replaced
+        cursor.execute('''
+            DELETE FROM measure USING tmp_lab_acquisition
+                WHERE measure.id_lab_acquisition = tmp_lab_acquisition.id;
+            DELETE FROM lab_acquisition USING tmp_lab_acquisition
+                WHERE lab_acquisition.id = tmp_lab_acquisition.id;
+        ''')
+        # insert acquisitions, building geometries server-side
+        cursor.execute('''
+            INSERT INTO lab_acquisition (id, lat, lon, time, nlab, nfield, depth, site, coords, hyperspectral)
+                SELECT id, lat, lon, now(), nlab, nfield, depth, site,
+                       ST_SetSRID(ST_MakePoint(lon, lat), 3003), hyperspectral
+                FROM tmp_lab_acquisition;
+        ''')
+        # insert measures
+        copy_from_frame(cursor, measures, 'measure', ['id_lab_acquisition', 'id_variable', 'value'])
+        db.session.commit()
+
+        return len(acquisitions)
+
+
+    def get_lab_pivot_columns(self):
+        """Returns the columns of the lab acquisitions pivot, read from the catalog once and then cached
+        until the pivot is rebuilt. The pivot is created if it does not exist yet.
+        """
+        if self.lab_pivot_columns:
+            return list(self.lab_pivot_columns)
+        columns = self._get_lab_pivot_columns()
+        if not columns:
+            self.refresh_lab_pivot()
+            columns = self._get_lab_pivot_columns()
+        self.lab_pivot_columns = columns
+        return list(columns)
+
+
+    def _get_lab_pivot_columns(self):
+        return [row[0] for row in db.session.execute(sa.text('''
+            SELECT attname FROM pg_attribute
+            WHERE attrelid = to_regclass(:name) AND attnum > 0 AND NOT attisdropped
+            ORDER BY attnum
+        '''), {'name': LAB_PIVOT}).all()]
+
+
+    def refresh_lab_pivot(self):
+        """Refreshes the materialized view pivoting the measures of each lab acquisition into columns.
+        The view is refreshed concurrently, so that reads are not blocked, and it is rebuilt
+        when it is missing or when the set of variables has changed.
+        """
+        var_names = [var[0] for var in db.session.query(variable.c.name).order_by(variable.c.id).all()]
+        columns = ['id', 'sito', 'latitude', 'longitude', 'time', 'nlab', 'ncampo', 'depth_cm', 'gamma'] + \
+                  [var.lower() for var in var_names] + ['hyperspectral']
+
+        db.session.execute(NO_STATEMENT_TIMEOUT)
+        if self._get_lab_pivot_columns() == columns:
+            db.session.execute(sa.text(f'REFRESH MATERIALIZED VIEW CONCURRENTLY {LAB_PIVOT}'))
+        else:
+            query = f'''
+            CREATE MATERIALIZED VIEW {LAB_PIVOT} AS
+            SELECT lab_acquisition.id, site.name AS sito, lab_acquisition.lat AS latitude, lab_acquisition.lon AS longitude, 
+                    lab_acquisition.time, lab_acquisition.nlab AS Nlab, lab_acquisition.nfield AS Ncampo, 
+                    lab_acquisition.depth AS depth_cm, lab_acquisition.gamma,
+            '''
+            for var in var_names:
+                query += f"MAX(measure.value) FILTER (WHERE variable.name = '{var}') as {var},"
+            query += f'''lab_acquisition.hyperspectral
+                FROM lab_acquisition
+                        LEFT OUTER JOIN site ON site.id = lab_acquisition.site
+                        LEFT OUTER JOIN measure ON lab_acquisition.id = measure.id_lab_acquisition 
+                        LEFT OUTER JOIN variable ON variable.id = measure.id_variable
+                    GROUP BY lab_acquisition.id, sito;
+            CREATE UNIQUE INDEX ON {LAB_PIVOT} (id);
+            CREATE INDEX ON {LAB_PIVOT} (sito);
+            CREATE INDEX ON {LAB_PIVOT} (time);
+            '''
+            db.session.execute(sa.text(f'DROP MATERIALIZED VIEW IF EXISTS {LAB_PIVOT}'))
+            db.session.execute(sa.text(query))
+            # the columns changed
+            self.lab_pivot_columns = None
         db.session.commit()
 
 
-    def insert_drone_acquisition(self, csv, sep=','):
+    def has_drone_acquisitions(self):
+        """Checks if there is at least one drone acquisition, the answer is cached until a deletion."""
+        if self.drone_acquisitions_exist is None:
+            self.drone_acquisitions_exist = db.session.query(sa.exists().where(drone_acq.c.id != None)).scalar()
+        return self.drone_acquisitions_exist
+
+
+    def get_export_query(self, dataset, geometry=False):
+        """Gets the query exporting all the lab ('lab') or drone ('drone') acquisitions.
+        With geometry, a 'geometry' column holds the point in WGS84 encoded as GeoJSON.
+        """
+        if dataset == 'lab':
+            # create the pivot if missing
+            self.get_lab_pivot_columns()
+            geom = ', ST_AsGeoJSON(ST_Transform(ST_SetSRID(ST_MakePoint(longitude, latitude), 3003), 4326)) AS geometry'
+            return sa.text(f'SELECT *{geom if geometry else ""} FROM {LAB_PIVOT} ORDER BY id')
+        if dataset == 'drone':
+            geom = ', ST_AsGeoJSON(ST_Transform(coords, 4326)) AS geometry'
+            return sa.text(f'''
+                SELECT drone_acquisition.id, drone_acquisition.time, site.name AS site, mission, path, acquisition,
+                       lat AS latitude, lon AS longitude, z, start_acq_time, stop_acq_time, 
+                       start_band, stop_band, gamma{geom if geometry else ""}
+                FROM drone_acquisition LEFT OUTER JOIN site ON site.id = drone_acquisition.site
+                ORDER BY drone_acquisition.id
+            ''')
+        raise ValueError(f'Dataset {dataset} not valid.')
+
+
+    def stream_query(self, query):
+        """Executes a query on a server-side cursor, so that the rows are fetched in batches."""
+        return db.session.execute(query, execution_options={'stream_results': True})
+
+
+    def insert_drone_acquisition(self, csv, sep=',', chunk_size=None, progress=None, max_rejected=1000, 
+                                 gamma_encoding=None, file_format='csv'):
+        report = {'chunks': 0, 'rows_read': 0, 'inserted': 0, 'rejected_count': 0, 'rejected': []}
+        # read file in chunks, writing each of them as it arrives
+        for df in read_chunks(csv, file_format=file_format, sep=sep, chunk_size=chunk_size):
+            cur_report = self.insert_drone_frame(df, first_row=report['rows_read'], gamma_encoding=gamma_encoding)
+            report['inserted'] += cur_report['inserted']
+            report['rejected_count'] += len(cur_report['rejected'])
+            # keep the detail of the rejected rows bounded
+            report['rejected'].extend(cur_report['rejected'][:max_rejected - len(report['rejected'])])
+            report['chunks'] += 1
+            report['rows_read'] += len(df)
+            if progress is not None:
+                progress(report)
+        # return the outcome of the ingestion
+        return report
+
+
+    def insert_drone_frame(self, df, first_row=0, time_format=None, gamma_encoding=None):
         header_mapping = {
             'start acq timestamp': 'start_acq_time',
             'stop acq timestamp': 'stop_acq_time',
@@ -178,81 +603,91 @@ class DBManager(object):
             'gamma': "gamma"
         }
 
-        # read file
-        df = pd.read_csv(csv, sep=sep)
-
         # check that the variables in the csv are contained in the dataset
         for key in header_mapping:
             if not key in df.columns:
                 raise ValueError(f'Variable {key} not present in CSV file.')
 
         # convert headers
-        new_cols = []
-        for i in range(len(df.columns)):
-            if df.columns[i] in header_mapping:
-                new_cols.append(header_mapping[df.columns[i]])
-            else:
-                new_cols.append(df.columns[i])
-        df.columns = new_cols
-
-        df['start_acq_time'] = pd.to_datetime(df['start_acq_time'])
-        df['stop_acq_time'] = pd.to_datetime(df['stop_acq_time'])
-        df['gamma'] = df['gamma'].apply(eval)
-
-        # get all sites
-        cur_sites = list(df['site'].unique())
-
-        # insert them if not present
-        for cur_site in cur_sites:
-            res = db.session.query(site).filter(site.c.name == cur_site).first()
-            if res is None:
-                s = site.insert().values(name=cur_site)
-                db.session.execute(s)
-
-        # get site ids
-        site_mapping = dict(db.session.query(site.c.name, site.c.id).all())
-
-        # for each sample
-        for i in range(len(df)):
-            # get it
-            cur_sample = df.iloc[i]
-            # create acquisition
-            cur_start_acq_time, cur_stop_acq_time, cur_site, cur_mission,\
-                cur_path, cur_acquisition, cur_lat, cur_lon, cur_z,\
-                cur_start_band, cur_stop_band, cur_gamma = \
-                    cur_sample[
-                        ['start_acq_time', 'stop_acq_time', 'site', 'mission',\
-                        'path', 'acquisition', 'lat', 'lon', 'z', 'start_band',\
-                        'stop_band', 'gamma']
-                    ]
-            # check timestamp consistency
-            if cur_stop_acq_time < cur_start_acq_time:
-                continue
-            # check band consistency
-            if cur_stop_band < cur_start_band:
-                continue
-            # define current time stamp
-            cur_time = datetime.now()
-            cur_site_id = site_mapping[cur_site]
-            # perform insert query
-            q = drone_acq.insert().values(
-                start_acq_time = cur_start_acq_time,
-                stop_acq_time= cur_stop_acq_time,
-                site = cur_site_id,
-                mission = cur_mission,
-                path = cur_path,
-                acquisition = cur_acquisition,
-                lat = cur_lat,
-                lon = cur_lon,
-                coords = func.ST_GeomFromText(f"POINT({cur_lon} {cur_lat})", 3003),
-                z = cur_z.item(),
-                start_band = cur_start_band.item(),
-                stop_band = cur_stop_band.item(),
-                gamma = cur_gamma,
-                time = cur_time
-            )
-            db.session.execute(q)
+        df = df.rename(columns=header_mapping)
+
+        # parse columns, marking non-valid values as missing
+        start_acq_time = pd.to_datetime(df['start_acq_time'], format=time_format, errors='coerce')
+        stop_acq_time = pd.to_datetime(df['stop_acq_time'], format=time_format, errors='coerce')
+        start_band = pd.to_numeric(df['start_band'], errors='coerce')
+        stop_band = pd.to_numeric(df['stop_band'], errors='coerce')
+        lat = pd.to_numeric(df['lat'], errors='coerce')
+        lon = pd.to_numeric(df['lon'], errors='coerce')
+        # gamma is a list of floats as text or, with an encoding, base64 of binary floats
+        if gamma_encoding is None or gamma_encoding == 'text':
+            gamma, valid_gamma = parse_pg_arrays(df['gamma'])
+        else:
+            gamma, valid_gamma = decode_pg_arrays(df['gamma'], gamma_encoding)
+
+        # validate all samples at once, each check reports only the rows not already rejected
+        checks = OrderedDict([
+            ('Timestamps not valid.', (start_acq_time.isna() | stop_acq_time.isna()).to_numpy()),
+            ('Timestamps not consistent.', (stop_acq_time < start_acq_time).to_numpy()),
+            ('Bands not valid.', (start_band.isna() | stop_band.isna()).to_numpy()),
+            ('Bands not consistent.', (stop_band < start_band).to_numpy()),
+            ('Coordinates not valid.', (lat.isna() | lon.isna()).to_numpy()),
+            ('Gamma values not in a valid format.', ~valid_gamma),
+        ])
+        rejected = np.zeros(len(df), dtype=bool)
+        report = {'inserted': 0, 'rejected': []}
+        for reason, mask in checks.items():
+            report['rejected'].extend({'row': first_row + int(i), 'reason': reason}
+                                      for i in np.flatnonzero(mask & ~rejected))
+            rejected |= mask
+
+        # keep valid samples only
+        accepted = ~rejected
+        acquisitions = pd.DataFrame({
+            'start_acq_time': start_acq_time,
+            'stop_acq_time': stop_acq_time,
+            'site': df['site'],
+            'mission': df['mission'],
+            'path': df['path'],
+            'acquisition': df['acquisition'],
+            'lat': lat,
+            'lon': lon,
+            'z': pd.to_numeric(df['z'], errors='coerce'),
+            'start_band': start_band,
+            'stop_band': stop_band,
+            'gamma': gamma,
+        })[accepted]
+
+        # get site ids, inserting the new sites
+        site_names = acquisitions['site'].dropna().astype(str)
+        site_mapping = self.get_site_ids(site_names.unique())
+        acquisitions['site'] = site_names.map(site_mapping).reindex(acquisitions.index).astype('Int64')
+
+        # work on the DBAPI connection of the session, so that everything runs in one transaction
+        cursor = db.session.connection().connection.cursor()
+        cursor.execute('''
+            CREATE TEMP TABLE tmp_drone_acquisition (
+                start_acq_time timestamp, stop_acq_time timestamp, site int, mission varchar(30),
+                path varchar(30), acquisition varchar(30), lat float, lon float, z float,
+                start_band float, stop_band float, gamma float[]
+            ) ON COMMIT DROP;
+        ''')
+        # insert, building geometries server-side
+        copy_from_frame(cursor, acquisitions, 'tmp_drone_acquisition', list(acquisitions.columns))
+        cursor.execute('''
+            INSERT INTO drone_acquisition (start_acq_time, stop_acq_time, site, mission, path, acquisition,
+                                           lat, lon, coords, z, start_band, stop_band, gamma, time)
+                SELECT start_acq_time, stop_acq_time, site, mission, path, acquisition,
+                       lat, lon, ST_SetSRID(ST_MakePoint(lon, lat), 3003), z::int,
+                       start_band::int, stop_band::int, gamma, now()
+                FROM tmp_drone_acquisition;
+        ''')
         db.session.commit()
+        if len(acquisitions) > 0:
+            self.drone_acquisitions_exist = True
+
+        report['inserted'] = len(acquisitions)
+        # return the outcome of the ingestion
+        return report
 
 
     def point_sampling_raster_from_single_table(self, table, lat, lon, epsg=4326, nodata_val=-99999):
@@ -292,27 +727,66 @@ class DBManager(object):
         return out
 
 
+    def point_sampling_raster_batch(self, tables, lats, lons, epsg=4326, nodata_val=-99999):
+        # convert table to list if a single string is passed
+        if not isinstance(tables, list):
+            tables = [tables]
+        # create points frame
+        points = pd.DataFrame({
+            'idx': np.arange(len(lats)),
+            'lon': np.asarray(lons, dtype=float),
+            'lat': np.asarray(lats, dtype=float)
+        })
+        # create output
+        out = pd.DataFrame(index=points.index)
+
+        # ship all the points at once in a spatially indexed temporary table
+        cursor = db.session.connection().connection.cursor()
+        cursor.execute('''
+            CREATE TEMP TABLE tmp_sampling_input (idx int, lon float, lat float) ON COMMIT DROP;
+        ''')
+        copy_from_frame(cursor, points, 'tmp_sampling_input', ['idx', 'lon', 'lat'])
+        cursor.execute(f'''
+            CREATE TEMP TABLE tmp_sampling_point ON COMMIT DROP AS
+                SELECT idx, ST_SetSRID(ST_MakePoint(lon, lat), {int(epsg)}) AS geom FROM tmp_sampling_input;
+            CREATE INDEX ON tmp_sampling_point USING GIST (geom);
+            ANALYZE tmp_sampling_point;
+        ''')
+
+        # for each table/raster
+        for cur_table in tables:
+            # sample all points with one query, keeping one value per point where tiles overlap
+            cursor.execute(f'''
+                SELECT DISTINCT ON (p.idx) p.idx, ST_Value(r.rast, 1, p.geom) AS val
+                FROM tmp_sampling_point AS p
+                    JOIN {cur_table} AS r ON ST_Intersects(r.rast, p.geom, 1)
+                ORDER BY p.idx;
+            ''')
+            res = np.array(cursor.fetchall(), dtype=float).reshape(-1, 2)
+            # points without a value get nodata_val
+            cur_feat = np.full(len(points), nodata_val, dtype=float)
+            cur_feat[res[:, 0].astype(int)] = np.where(np.isnan(res[:, 1]), nodata_val, res[:, 1])
+            out[cur_table] = cur_feat
+        db.session.commit()
+        # return the collected samples
+        return out
+
+
     def point_sampling_raster_from_csv(self, csv, tables, epsg=4326, sep=',', lat_col='GPS_LAT', lon_col='GPS_LONG', nodata_val=-99999):
-        # import pandarallel
-        # from pandarallel import pandarallel
-        # pandarallel.initialize(nb_workers=8, progress_bar=True)
+        # convert table to list if a single string is passed
+        if not isinstance(tables, list):
+            tables = [tables]
         # read csv
         df = pd.read_csv(csv, sep=sep)
         # keep only coordinates
-        df = df[[lat_col, lon_col]]
-        # add empty cols
-        for cur_table in tables: df[cur_table] = nodata_val
-        # fill them
-        for index, x in tqdm(df.iterrows(), total=len(df)):
-            vals = self.point_sampling_raster(tables, x[lat_col], x[lon_col], epsg=epsg, nodata_val=nodata_val)
-            for cur_table in tables:
-                # x[cur_table] = vals[cur_table]
-                df.loc[index, cur_table] = vals[cur_table]
+        df = df[[lat_col, lon_col]].reset_index(drop=True)
+        # sample all points in batch
+        samples = self.point_sampling_raster_batch(tables, df[lat_col], df[lon_col], epsg=epsg, nodata_val=nodata_val)
         # return dataframe with retrieved info
-        return df
+        return pd.concat([df, samples], axis=1)
 
 
-    def create_views(self):
+    def create_views(self, materialized=False, only_missing=False):
         # init variable containing views names
         self.views = OrderedDict({'lab_acquisition':OrderedDict(), 'estimated':OrderedDict()})
 
@@ -330,8 +804,8 @@ class DBManager(object):
                     .where(lab_acq.c.id == measure.c.id_lab_acquisition)\
                     .where(lab_acq.c.site == site.c.id)\
                     .where(measure.c.id_variable == variable.c.id)\
-                    .where(variable.c.id == cur_var_id))
-            engine.execute(view)
+                    .where(variable.c.id == cur_var_id), materialized=materialized)
+            self.create_layer_view(view, unique_id=True, only_missing=only_missing)
             # append name of just-created view
             self.views['lab_acquisition'][cur_var_name] = view_name
 
@@ -366,8 +840,8 @@ class DBManager(object):
                             .where(estimation.c.id == estimated_value.c.id_estimation)\
                             .where(estimated_value.c.id_variable == variable.c.id)\
                             .where(variable.c.id == cur_var_id)\
-                            .where(model.c.id == cur_model_id))
-                engine.execute(view)
+                            .where(model.c.id == cur_model_id), materialized=materialized)
+                self.create_layer_view(view, unique_id=False, only_missing=only_missing)
                 # append
                 self.views['estimated'][cur_model_name][cur_var_name] = view_name
 
@@ -376,6 +850,57 @@ class DBManager(object):
         return self.views
 
 
+    def create_layer_view(self, view, unique_id=False, only_missing=False):
+        """Creates a layer view. A materialized one replaces any plain view with the same name
+        (and vice versa) and gets a GIST index on coords, plus a unique index on id when
+        unique_id is True, which allows it to be refreshed concurrently.
+        If only_missing is True, a view which already exists with the requested kind is left untouched.
+        """
+        quoted_name = engine.dialect.identifier_preparer.quote(view.name)
+        relkind = db.session.execute(sa.text('SELECT relkind FROM pg_class WHERE oid = to_regclass(:name)'), 
+                                     {'name': quoted_name}).scalar()
+        if not view.materialized and relkind == 'v' and only_missing:
+            return
+        # in a transaction, for the statement timeout to be set (and lifted) behind pgbouncer too
+        with engine.begin() as conn:
+            conn.execute(NO_STATEMENT_TIMEOUT)
+            if view.materialized:
+                if relkind == 'v':
+                    conn.execute(DropView(view.name))
+                if relkind != 'm':
+                    conn.execute(view)
+                    conn.execute(sa.text(f'CREATE INDEX ON {quoted_name} USING GIST (coords)'))
+                    if unique_id:
+                        conn.execute(sa.text(f'CREATE UNIQUE INDEX ON {quoted_name} (id)'))
+            else:
+                if relkind == 'm':
+                    conn.execute(DropView(view.name, materialized=True))
+                conn.execute(view)
+
+
+    def refresh_layer_views(self, prefix, tables=None):
+        """Refreshes the materialized layer views whose name starts with prefix ('lab_' or 'est_'),
+        only those which depend on one of the given tables if tables is not None.
+        Views with a unique index are refreshed concurrently, so that map requests are not blocked.
+        """
+        matviews = db.session.execute(sa.text('''
+            SELECT matviewname,
+                   EXISTS (SELECT 1 FROM pg_index 
+                           WHERE indrelid = to_regclass(quote_ident(matviewname)) AND indisunique)
+            FROM pg_matviews 
+            WHERE schemaname = current_schema() AND starts_with(matviewname, :prefix) AND matviewname <> :pivot
+                  AND (CAST(:tables AS text[]) IS NULL OR EXISTS (
+                      SELECT 1 FROM pg_depend d JOIN pg_rewrite r ON r.oid = d.objid
+                      WHERE r.ev_class = to_regclass(quote_ident(matviewname))
+                            AND d.refobjid IN (SELECT to_regclass(t) FROM unnest(CAST(:tables AS text[])) t)))
+        '''), {'prefix': prefix, 'pivot': LAB_PIVOT, 'tables': None if tables is None else list(tables)}).all()
+        db.session.execute(NO_STATEMENT_TIMEOUT)
+        for cur_view, cur_unique in matviews:
+            db.session.execute(sa.text('REFRESH MATERIALIZED VIEW {}{}'.format(
+                'CONCURRENTLY ' if cur_unique else '', engine.dialect.identifier_preparer.quote(cur_view))))
+        db.session.commit()
+
+
     def get_rasters(self):
         return db.session.query(raster_master.c.id, 
                                 raster_master.c.layer_name,
@@ -383,23 +908,313 @@ class DBManager(object):
                                 .filter(raster_master.c.visible == True).all()
 
 
-    def insert_raster(self, raster_fn, table_name=None, target_epsg=4326, nodata_val=0):
-        # get path of raster
-        raster_path = os.path.dirname(raster_fn)
-        # define temporary raster
-        temp_raster = os.path.join(raster_path, 'tmp.tif')
-        # convert to target epsg
-        os.system(f"gdalwarp -t_srs EPSG:{target_epsg} -overwrite {raster_fn} {temp_raster}")
-        # send to db
-        os.system( \
-            f"raster2pgsql -s {target_epsg} -N {nodata_val} -d -C -I -M {temp_raster} -t 256x256 public.raster_{table_name} | " + \
-            f"psql -h {self.host} -p {self.port} -U {self.user} -d {self.database}" \
-        )
-        # remove temporary raster
-        os.remove(temp_raster)
+    def get_vectors(self):
+        return db.session.query(vector_master.c.id, 
+                                vector_master.c.layer_name,
+                                vector_master.c.table_name)\
+                                .filter(vector_master.c.visible == True).all()
+
+
+    def get_raster_version(self, table_name):
+        """Gets the version of the content of a raster table, incremented each time the raster
+        is imported again (see register_raster). Returns None if the raster is not registered.
+        """
+        version = db.session.query(raster_master.c.version)\
+                            .filter(raster_master.c.table_name == table_name).scalar()
+        return None if version is None else str(version)
+
+
+    def get_raster_stats(self, table_name, num_classes=100, bins=1024):
+        """Gets min, max, histogram and quantile breaks of the first band of a raster table.
+        The statistics are read from the raster_stats table, and computed and stored only 
+        when the version of the raster (see get_raster_version) has changed since they were cached.
+
+        Returns None if the raster is not registered or has no valid pixels.
+        """
+        version = self.get_raster_version(table_name)
+        if version is None:
+            return None
+        cached = db.session.execute(sa.text(f'''
+            SELECT min, max, count, histogram, breaks FROM {RASTER_STATS}
+            WHERE table_name = :table_name AND version = :version AND num_classes = :num_classes
+                  AND cardinality(histogram) = :bins
+        '''), {'table_name': table_name, 'version': version, 'num_classes': num_classes, 'bins': bins}).first()
+        if cached is not None:
+            db.session.commit()
+            return dict(cached._mapping)
+
+        # min/max over all the tiles, then a fixed width histogram of the valid pixels
+        db.session.execute(NO_STATEMENT_TIMEOUT)
+        table = engine.dialect.identifier_preparer.quote(table_name)
+        min_val, max_val, count = db.session.execute(sa.text(f'''
+            SELECT (s).min, (s).max, (s).count FROM (SELECT ST_SummaryStatsAgg(rast, 1, true) AS s FROM {table}) t
+        ''')).first()
+        if not count:
+            db.session.commit()
+            return None
+        histogram = np.zeros(bins, dtype=np.int64)
+        if max_val > min_val:
+            buckets = db.session.execute(sa.text(f'''
+                SELECT LEAST(width_bucket(v, :min, :max, :bins), :bins) AS bucket, count(*)
+                FROM (SELECT unnest(ST_DumpValues(rast, 1, true)) AS v FROM {table}) t
+                WHERE v IS NOT NULL
+                GROUP BY 1
+            '''), {'min': min_val, 'max': max_val, 'bins': bins}).all()
+            for cur_bucket, cur_count in buckets:
+                histogram[cur_bucket - 1] = cur_count
+            # quantile breaks interpolated on the cumulative histogram
+            edges = np.linspace(min_val, max_val, bins + 1)
+            cdf = np.concatenate([[0], np.cumsum(histogram)]) / histogram.sum()
+            breaks = np.interp(np.linspace(0, 1, num_classes), cdf, edges)
+        else:
+            histogram[0] = count
+            breaks = np.full(num_classes, min_val)
+
+        stats = {'min': min_val, 'max': max_val, 'count': count, 
+                 'histogram': histogram.tolist(), 'breaks': breaks.tolist()}
+        db.session.execute(sa.text(f'''
+            INSERT INTO {RASTER_STATS} (table_name, version, min, max, count, histogram, num_classes, breaks)
+            VALUES (:table_name, :version, :min, :max, :count, :histogram, :num_classes, :breaks)
+            ON CONFLICT (table_name) DO UPDATE SET 
+                version = EXCLUDED.version, min = EXCLUDED.min, max = EXCLUDED.max, count = EXCLUDED.count,
+                histogram = EXCLUDED.histogram, num_classes = EXCLUDED.num_classes, breaks = EXCLUDED.breaks,
+                updated = now()
+        '''), dict(stats, table_name=table_name, version=version, num_classes=num_classes))
+        db.session.commit()
+        return stats
+
+
+    def insert_raster(self, raster_fn, table_name, target_epsg=4326, nodata_val=0, layer_name=None, 
+                      description=None, out_db_dir=None, work_dir=None, progress=None):
+        """Reprojects a raster, loads it in the raster_<table_name> table and registers it in raster_master.
+        gdalwarp, raster2pgsql and psql run as subprocesses, without a shell: the SQL written by raster2pgsql
+        is streamed to psql and the loaded tiles are counted as they pass. The intermediate files are written 
+        in work_dir, a new temporary directory (removed at the end) if None.
+        The tile size is chosen from the raster size and overviews (o_<factor>_raster_<table_name>) are built
+        down to a single tile, so that zoomed-out renders read a few tiles only. With out_db_dir, the pixels 
+        are kept out of the database, in a tiled GeoTIFF with internal overviews (i.e. a Cloud-Optimized 
+        GeoTIFF) written in out_db_dir, which has to be readable by the database server at the same path.
+
+        Parameters
+        ----------
+        raster_fn: path of the raster file
+        table_name: name of the raster, the table is raster_<table_name>
+        target_epsg: EPSG code of the loaded raster (default is 4326)
+        nodata_val: value of the pixels with no data (default is 0)
+        layer_name: name of the layer in the project (default is table_name)
+        description: description of the raster
+        out_db_dir: directory of the out-db rasters, if None the pixels are loaded in the database
+        work_dir: directory of the intermediate files
+        progress: function called with the report as the import goes on
+
+        Returns
+        -------
+        dict : the report of the import
+        """
+        if not re.fullmatch(TABLE_NAME_PATTERN, table_name or ''):
+            raise ValueError(f"Raster name {table_name} not valid.")
+        raster_table = f'raster_{table_name}'
+        report = {'table_name': raster_table, 'step': 'warp', 'tiles': None, 'tiles_loaded': 0}
+        own_dir = work_dir is None
+        if own_dir:
+            work_dir = tempfile.mkdtemp(prefix='raster_')
+        try:
+            if progress is not None:
+                progress(report)
+            # convert to target epsg, in a file of this import only
+            temp_raster = os.path.join(work_dir, 'warped.tif')
+            run_tool(['gdalwarp', '-t_srs', f'EPSG:{target_epsg}', '-overwrite', '-co', 'TILED=YES', 
+                      '-co', 'BIGTIFF=IF_SAFER', raster_fn, temp_raster])
+            width, height = raster_size(temp_raster)
+            tile_size = raster_tile_size(width, height)
+            factors = overview_factors(width, height, tile_size)
+            report.update(tile_size=list(tile_size), overviews=factors, out_db=out_db_dir is not None,
+                          tiles=count_tiles(width, height, tile_size, factors))
+            load_raster = temp_raster
+            if out_db_dir is not None:
+                report['step'] = 'overviews'
+                if progress is not None:
+                    progress(report)
+                # internal overviews, then a tiled copy of the raster keeping them
+                if factors:
+                    run_tool(['gdaladdo', '-r', 'average', temp_raster] + [str(factor) for factor in factors])
+                os.makedirs(out_db_dir, exist_ok=True)
+                load_raster = os.path.abspath(os.path.join(out_db_dir, f'{raster_table}.tif'))
+                run_tool(['gdal_translate', '-co', 'TILED=YES', '-co', 'COPY_SRC_OVERVIEWS=YES', 
+                          '-co', 'COMPRESS=DEFLATE', '-co', 'BIGTIFF=IF_SAFER', temp_raster, load_raster + '.part'])
+                os.replace(load_raster + '.part', load_raster)
+            report['step'] = 'load'
+            if progress is not None:
+                progress(report)
+
+            # send to db, one INSERT per tile, in a single transaction
+            loader_args = ['raster2pgsql', '-s', str(target_epsg), '-N', str(nodata_val), '-d', '-C', '-I', '-M', 
+                           '-t', f'{tile_size[0]}x{tile_size[1]}']
+            if factors:
+                loader_args += ['-l', ','.join(str(factor) for factor in factors)]
+            if out_db_dir is not None:
+                loader_args.append('-R')
+            loader_args += [load_raster, f'public.{raster_table}']
+            loader_log = os.path.join(work_dir, 'raster2pgsql.log')
+            writer_log = os.path.join(work_dir, 'psql.log')
+            with open(loader_log, 'wb') as loader_err, open(writer_log, 'wb') as writer_err:
+                loader = subprocess.Popen(loader_args, stdout=subprocess.PIPE, stderr=loader_err)
+                writer = subprocess.Popen(['psql', '-X', '-q', '-v', 'ON_ERROR_STOP=1'], 
+                                          stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=writer_err, 
+                                          env=pg_env())
+                try:
+                    for line in loader.stdout:
+                        writer.stdin.write(line)
+                        if line.startswith(b'INSERT INTO'):
+                            report['tiles_loaded'] += 1
+                            if progress is not None:
+                                progress(report)
+                    writer.stdin.close()
+                except BrokenPipeError:
+                    # psql stopped on an error, reported below
+                    pass
+                finally:
+                    loader.stdout.close()
+                    loader.wait()
+                    writer.wait()
+            if writer.returncode != 0:
+                raise tool_error('psql', writer_log)
+            if loader.returncode != 0:
+                raise tool_error('raster2pgsql', loader_log)
+
+            report['step'] = 'register'
+            if progress is not None:
+                progress(report)
+            self.register_raster(raster_table, layer_name or table_name, description)
+            report['step'] = 'done'
+            if progress is not None:
+                progress(report)
+            return report
+        finally:
+            # remove temporary raster
+            if own_dir:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+
+    def register_raster(self, table_name, layer_name, description=None):
+        # update the raster if already registered, e.g. when imported again, with a new version
+        updated = db.session.execute(raster_master.update()
+                                     .where(raster_master.c.table_name == table_name)
+                                     .values(layer_name=layer_name, description=description, visible=True,
+                                             version=raster_master.c.version + 1))
+        if updated.rowcount == 0:
+            db.session.execute(raster_master.insert().values(
+                table_name=table_name, layer_name=layer_name, description=description, visible=True))
+        db.session.commit()
+
+
+    def inspect_vectors(self, path, work_dir):
+        """Lists the layers of a GeoPackage, a shapefile or a zip of them.
+
+        Returns
+        -------
+        list : source file name, layer name, geometry type, feature count and EPSG code of each layer
+        """
+        return [dict(layer, source=vector_source_name(cur_source, work_dir)) 
+                for cur_source in extract_vector_sources(path, work_dir) 
+                for layer in list_vector_layers(cur_source)]
+
+
+    def insert_vectors(self, path, layers=None, target_epsg=3003, work_dir=None, max_workers=4, 
+                       group_size=100000, progress=None):
+        """Imports the layers of a GeoPackage, a shapefile or a zip of them in vector_<layer name> tables and
+        registers them in vector_master. The layers are loaded concurrently, one ogr2ogr each, through COPY
+        and in transactions of group_size features. The spatial index is built once a layer is loaded.
+
+        Parameters
+        ----------
+        path: path of the file
+        layers: names of the layers to import, all if None
+        target_epsg: EPSG code of the loaded layers (default is 3003)
+        work_dir: directory where a zip is extracted, a new temporary directory (removed at the end) if None
+        max_workers: layers loaded at the same time (default is 4)
+        group_size: features per transaction (default is 100000)
+        progress: function called with the report as the import goes on
+
+        Returns
+        -------
+        dict : the report of the import, with the outcome of each layer
+        """
+        own_dir = work_dir is None
+        if own_dir:
+            work_dir = tempfile.mkdtemp(prefix='vector_')
+        try:
+            # select the layers
+            taken = set()
+            selected = []
+            for cur_source in extract_vector_sources(path, work_dir):
+                for cur_layer in list_vector_layers(cur_source):
+                    if layers is None or cur_layer['name'] in layers:
+                        selected.append(dict(cur_layer, source=cur_source, 
+                                             table_name=vector_table_name(cur_layer['name'], taken)))
+            missing = set(layers or ()) - {cur_layer['name'] for cur_layer in selected}
+            report = {'layers': len(selected), 'layers_loaded': 0, 'missing': sorted(missing), 
+                      'results': [{'layer': cur_layer['name'], 'source': vector_source_name(cur_layer['source'], work_dir), 
+                                   'table_name': cur_layer['table_name'], 'status': 'queued'} 
+                                  for cur_layer in selected]}
+            lock = threading.Lock()
+            if progress is not None:
+                progress(report)
+
+            def load(i):
+                cur_layer = selected[i]
+                result = report['results'][i]
+                result['status'] = 'loading'
+                if progress is not None:
+                    progress(report)
+                try:
+                    run_tool(['ogr2ogr', '-f', 'PostgreSQL', f'PG:dbname={engine.url.database}', cur_layer['source'], 
+                              cur_layer['name'], '-nln', f"public.{cur_layer['table_name']}", '-overwrite', 
+                              '-t_srs', f'EPSG:{target_epsg}', '-nlt', 'PROMOTE_TO_MULTI', 
+                              '-lco', 'GEOMETRY_NAME=coords', '-lco', 'FID=id', '-lco', 'SPATIAL_INDEX=NONE',
+                              '-gt', str(group_size), '--config', 'PG_USE_COPY', 'YES'], env=pg_env())
+                    # index once loaded, faster than updating it at each insert
+                    with engine.begin() as conn:
+                        conn.execute(NO_STATEMENT_TIMEOUT)
+                        conn.execute(sa.text(f"CREATE INDEX IF NOT EXISTS {cur_layer['table_name']}_coords_idx "
+                                             f"ON {cur_layer['table_name']} USING GIST (coords)"))
+                        conn.execute(sa.text(f"ANALYZE {cur_layer['table_name']}"))
+                    result['status'] = 'loaded'
+                except Exception as e:
+                    result['status'] = 'failed'
+                    result['error'] = str(e)
+                with lock:
+                    report['layers_loaded'] += 1
+                    if progress is not None:
+                        progress(report)
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(load, range(len(selected))))
+
+            # register the loaded layers
+            for cur_layer, result in zip(selected, report['results']):
+                if result['status'] == 'loaded':
+                    self.register_vector(cur_layer['table_name'], cur_layer['name'][:60], 
+                                         source=vector_source_name(cur_layer['source'], work_dir)[:200],
+                                         geometry_type=cur_layer['geometry_type'], features=cur_layer['features'])
+            return report
+        finally:
+            if own_dir:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+
+    def register_vector(self, table_name, layer_name, source=None, geometry_type=None, features=None):
+        # update the layer if already registered, e.g. when imported again
+        db.session.execute(sa.text('''
+            INSERT INTO vector_master (table_name, layer_name, source, geometry_type, features, visible)
+            VALUES (:table_name, :layer_name, :source, :geometry_type, :features, true)
+            ON CONFLICT (table_name) DO UPDATE SET 
+                layer_name = EXCLUDED.layer_name, source = EXCLUDED.source, geometry_type = EXCLUDED.geometry_type,
+                features = EXCLUDED.features, visible = true
+        '''), {'table_name': table_name, 'layer_name': layer_name, 'source': source, 
+               'geometry_type': geometry_type, 'features': features})
+        db.session.commit()
 
 
     def insert_gkpg(self, gpkg_path):
-        cmd = f'ogr2ogr -f PostgreSQL "PG:user={self.user} password={self.password} ' + \
-              f'dbname={self.database} host={self.host} port={self.port}" {gpkg_path}'
-        os.system(cmd)
\ No newline at end of file
+        return self.insert_vectors(gpkg_path)
\ No newline at end of file
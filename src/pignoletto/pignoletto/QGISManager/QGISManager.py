@@ -3,6 +3,7 @@
 # source venv/bin/activate export PYTHONPATH=/usr/share/qgis/python export LD_LIBRARY_PATH=/usr/lib
 
 import sys, os, json, shutil
+from contextlib import contextmanager
 import qgis.core
 from qgis.core import (
     QgsApplication, 
@@ -12,6 +13,7 @@ from qgis.core import (
     QgsRasterBandStats, 
     QgsColorRampShader,
     QgsSingleBandPseudoColorRenderer,
+    QgsRasterShader,
     QgsVectorLayer,
     QgsDataSourceUri,
     QgsLayerTreeGroup,
@@ -62,10 +64,15 @@ class QGISManager:
             base_path = os.path.join(os.path.join(os.getcwd(), "pignoletto/QGISManager"), "pignoletto.qgs")
             self.project.read(base_path)
             self.project.write(self.project_path)
+        # nesting level of batch() blocks and whether a write was deferred
+        self._batch_depth = 0
+        self._dirty = False
+        # name -> layer, layer tree node and group indexes
+        self._reindex()
         print("QGIS project instance created.")
     
 
-    def add_Raster_layer(self, filename, num_classes=100, color="Viridis", group=None):
+    def add_Raster_layer(self, filename, num_classes=100, color="Viridis", group=None, stats=None):
         """Adds a Raster layer to the QGIS instance and updates the QGIS project file.
 
         Parameters
@@ -74,42 +81,20 @@ class QGISManager:
         num_classes: the number of classes which will be use to quantize the tiff' values (default is 100)
         color: the name of the color ramp to apply (default is "Viridis")
         group: a group name (default is None), if specified insert the layer in the group
+        stats: (optional) cached statistics of the raster with the quantile "breaks", if specified 
+               the classes are not computed from the raster
         """
         name = filename.split('/')[-1].split(".")[0]
         raster_layer = QgsRasterLayer(filename, name)
 
-        if not self.project.mapLayersByName(raster_layer.name()):
+        if raster_layer.name() not in self._layers:
             if not raster_layer.isValid():
                 print("Error: Raster file isn't valid.")
             else:
-                if group and not self.project.layerTreeRoot().findGroup(group):
-                    print("Error: the specified group does not exist.")
+                if not self._add_to_tree(raster_layer, group):
                     return
-                elif group and self.project.layerTreeRoot().findGroup(group):
-                    g = self.project.layerTreeRoot().findGroup(group)
-                    if raster_layer.name() in [child.name() for child in g.children()]:
-                        print(f"Error: there is already a layer {raster_layer.name()} in group {group}.")
-                        return
-                    else:
-                        self.project.layerTreeRoot().setItemVisibilityCheckedRecursive(False)
-                        self.project.addMapLayer(raster_layer, False)
-                        g.addLayer(raster_layer)
-                else:
-                    if raster_layer.name() in [child.name() for child in self.project.layerTreeRoot().children()]:
-                        print("Error: The name of this layer is already used by another layer.")
-                        return
-                    else:
-                        self.project.layerTreeRoot().setItemVisibilityCheckedRecursive(False)
-                        self.project.addMapLayer(raster_layer)
-
-                if color not in self.color_names:
-                    color="Viridis"
-                color_ramp = QgsStyle().defaultStyle().colorRamp(color)
-
-                renderer = QgsSingleBandPseudoColorRenderer(raster_layer.dataProvider(), 1)
-                renderer.createShader(color_ramp, colorRampType=QgsColorRampShader.Interpolated, 
-                    classificationMode=QgsColorRampShader.Quantile, classes=num_classes)
-                raster_layer.setRenderer(renderer)
+
+                raster_layer.setRenderer(self.create_renderer(raster_layer, color, num_classes, stats))
         
                 raster_layer.triggerRepaint()
 
@@ -136,29 +121,12 @@ class QGISManager:
             print("Error: specified reference system isn't valid.")
             return
         vector_layer.setCrs(crs)
-        if not self.project.mapLayersByName(vector_layer.name()):
+        if vector_layer.name() not in self._layers:
             if not vector_layer.isValid():
                 print("Error: Vector file isn't valid.")
             else:
-                if group and not self.project.layerTreeRoot().findGroup(group):
-                    print("Error: the specified group does not exist.")
+                if not self._add_to_tree(vector_layer, group):
                     return
-                elif group and self.project.layerTreeRoot().findGroup(group):
-                    g = self.project.layerTreeRoot().findGroup(group)
-                    if vector_layer.name() in [child.name() for child in g.children()]:
-                        print(f"Error: there is already a layer {vector_layer.name()} in group {group}.")
-                        return
-                    else:
-                        self.project.layerTreeRoot().setItemVisibilityCheckedRecursive(False)
-                        self.project.addMapLayer(vector_layer, False)
-                        g.addLayer(vector_layer)
-                else:
-                    if vector_layer.name() in [child.name() for child in self.project.layerTreeRoot().children()]:
-                        print("Error: The name of this layer is already used by another layer.")
-                        return
-                    else:
-                        self.project.layerTreeRoot().setItemVisibilityCheckedRecursive(False)
-                        self.project.addMapLayer(vector_layer)
 
                 self.commit()
                 print(f"Vector layer {name} added to the project.")
@@ -185,29 +153,12 @@ class QGISManager:
         vector_layer = QgsVectorLayer(uri, layer_name, "delimitedtext")
         vector_layer.setCrs(self.project.crs())
 
-        if not self.project.mapLayersByName(vector_layer.name()):
+        if vector_layer.name() not in self._layers:
             if not vector_layer.isValid():
                 print("Error: csv file isn't valid.")
             else:
-                if group and not self.project.layerTreeRoot().findGroup(group):
-                    print("Error: the specified group does not exist.")
+                if not self._add_to_tree(vector_layer, group):
                     return
-                elif group and self.project.layerTreeRoot().findGroup(group):
-                    g = self.project.layerTreeRoot().findGroup(group)
-                    if vector_layer.name() in [child.name() for child in g.children()]:
-                        print(f"Error: there is already a layer {vector_layer.name()} in group {group}.")
-                        return
-                    else:
-                        self.project.layerTreeRoot().setItemVisibilityCheckedRecursive(False)
-                        self.project.addMapLayer(vector_layer, False)
-                        g.addLayer(vector_layer)
-                else:
-                    if vector_layer.name() in [child.name() for child in self.project.layerTreeRoot().children()]:
-                        print("Error: The name of this layer is already used by another layer.")
-                        return
-                    else:
-                        self.project.layerTreeRoot().setItemVisibilityCheckedRecursive(False)
-                        self.project.addMapLayer(vector_layer)
 
                 self.commit()
                 print(f"Vector layer {layer_name} added to the project.")
@@ -246,29 +197,12 @@ class QGISManager:
         crs = layer.crs()
         if not crs.isValid():
             layer.setCrs(self.project.crs())
-        if not self.project.mapLayersByName(layer.name()):
+        if layer.name() not in self._layers:
             if not layer.isValid():
                 print("Error: PostGIS vector file isn't valid.")
             else:
-                if group and not self.project.layerTreeRoot().findGroup(group):
-                    print("Error: the specified group does not exist.")
+                if not self._add_to_tree(layer, group):
                     return
-                elif group and self.project.layerTreeRoot().findGroup(group):
-                    g = self.project.layerTreeRoot().findGroup(group)
-                    if layer.name() in [child.name() for child in g.children()]:
-                        print(f"Error: there is already a layer {layer.name()} in group {group}.")
-                        return
-                    else:
-                        self.project.layerTreeRoot().setItemVisibilityCheckedRecursive(False)
-                        self.project.addMapLayer(layer, False)
-                        g.addLayer(layer)
-                else:
-                    if layer.name() in [child.name() for child in self.project.layerTreeRoot().children()]:
-                        print("Error: The name of this layer is already used by another layer.")
-                        return
-                    else:
-                        self.project.layerTreeRoot().setItemVisibilityCheckedRecursive(False)
-                        self.project.addMapLayer(layer)
 
                 self.commit()
                 print(f"Vector layer {layer_name} added to the project.")
@@ -278,7 +212,7 @@ class QGISManager:
 
     def add_PostGIS_raster_layer(self, host_name, port, db_name, username, password, schema,
                 table_name, num_classes=100, color="Viridis",
-                layer_name=None, pk=None, filter=None, group=None):
+                layer_name=None, pk=None, filter=None, group=None, stats=None):
         """Adds a PostGIS raster layer to the QGIS instance and updates the QGIS project file.
 
         Parameters
@@ -296,6 +230,8 @@ class QGISManager:
         pk: (optional) primary key field
         filter: (optional) a subset filter string to be applied to the source, and should take the form of a SQL “where” clause (e.g. “VALUE > 5”, “CAT IN (1,2,3)”)
         group: (optional) a group name, if specified insert the layer in the group
+        stats: (optional) cached statistics of the raster with the quantile "breaks" (see DBManager.get_raster_stats), 
+               if specified the classes are not computed scanning the raster through the provider
         """
         if layer_name is None:
             layer_name = table_name
@@ -308,37 +244,14 @@ class QGISManager:
         
         layer = QgsRasterLayer(uri.uri(False), layer_name, "postgresraster")
         
-        if not self.project.mapLayersByName(layer.name()):
+        if layer.name() not in self._layers:
             if not layer.isValid():
                 print("Error: Raster file isn't valid.")
             else:
-                if group and not self.project.layerTreeRoot().findGroup(group):
-                    print("Error: the specified group does not exist.")
+                if not self._add_to_tree(layer, group):
                     return
-                elif group and self.project.layerTreeRoot().findGroup(group):
-                    g = self.project.layerTreeRoot().findGroup(group)
-                    if layer.name() in [child.name() for child in g.children()]:
-                        print(f"Error: there is already a layer {layer.name()} in group {group}.")
-                        return
-                    else:
-                        self.project.layerTreeRoot().setItemVisibilityCheckedRecursive(False)
-                        self.project.addMapLayer(layer, False)
-                        g.addLayer(layer)
-                else:
-                    if layer.name() in [child.name() for child in self.project.layerTreeRoot().children()]:
-                        print("Error: The name of this layer is already used by another layer.")
-                        return
-                    else:
-                        self.project.layerTreeRoot().setItemVisibilityCheckedRecursive(False)
-                        self.project.addMapLayer(layer)
-
-                if color not in self.color_names:
-                    color="Viridis"
-                color_ramp = QgsStyle().defaultStyle().colorRamp(color)
-                renderer = QgsSingleBandPseudoColorRenderer(layer.dataProvider(), 1)
-                renderer.createShader(color_ramp, colorRampType=QgsColorRampShader.Interpolated, 
-                    classificationMode=QgsColorRampShader.Quantile, classes=num_classes)
-                layer.setRenderer(renderer)
+
+                layer.setRenderer(self.create_renderer(layer, color, num_classes, stats))
                 layer.triggerRepaint()
                 self.commit()
                 print(f"Raster layer {layer_name} added to the project.")
@@ -354,26 +267,27 @@ class QGISManager:
         group_name: The name of the new group.
         layer_name: The layer to move.
         """
-        if not self.project.mapLayersByName(layer_name):
+        if layer_name not in self._layers:
             print(f"Error: layer {layer_name} not found.")
         else:
-            if self.project.layerTreeRoot().findGroup(group_name):
+            if group_name in self._groups:
                 root = self.project.layerTreeRoot()
-                parent = root.findGroup(group_name)
-                layer = self.project.mapLayersByName(layer_name)[0]
-                if layer.name() in [c.name() for c in parent.children()]:
+                parent = self._groups[group_name]
+                thelayer = self._nodes.get(layer_name)
+                if thelayer is None:
+                    print(f"Error: cannot find layer {layer_name}")
+                elif thelayer.parent() is not None and thelayer.parent().name() == group_name:
                     print(f"There is already a layer {layer_name} in group {parent.name()}.")
                 else:
-                    thelayer = next((l for l in root.children() if l.name()==layer.name()), root.findLayer(layer.id()))
-                    if thelayer is None:
-                        print(f"Error: cannot find layer {layer.name()}")
-                    else:
-                        myClone = thelayer.clone()
-                        parent.addChildNode(myClone)
-                        parent = root if thelayer.parent() == None else thelayer.parent()
-                        parent.removeChildNode(thelayer)
-                        self.commit()
-                        print(f"Layer {layer_name} inserted in group {group_name}.")
+                    myClone = thelayer.clone()
+                    parent.addChildNode(myClone)
+                    old_parent = root if thelayer.parent() == None else thelayer.parent()
+                    self._forget_node(thelayer)
+                    old_parent.removeChildNode(thelayer)
+                    self._nodes[layer_name] = myClone
+                    self._checked.append(myClone)
+                    self.commit()
+                    print(f"Layer {layer_name} inserted in group {group_name}.")
             else:
                 print(f"Error: group {group_name} not found.")
 
@@ -385,8 +299,10 @@ class QGISManager:
         ----------
         group_name: The name of the new group.
         """
-        if not self.project.layerTreeRoot().findGroup(group_name):
-            self.project.layerTreeRoot().insertGroup(0, group_name)
+        if group_name not in self._groups:
+            group = self.project.layerTreeRoot().insertGroup(0, group_name)
+            self._groups[group_name] = group
+            self._checked.append(group)
             self.commit()
             print(f"Group {group_name} added.")
         else:
@@ -400,11 +316,12 @@ class QGISManager:
         ----------
         group_name: The name of the group.
         """
-        if self.project.layerTreeRoot().findGroup(group_name):
+        if group_name in self._groups:
             root = self.project.layerTreeRoot()
-            group = root.findGroup(group_name)
+            group = self._groups[group_name]
             parent = root if group.parent() == None else group.parent()
             parent.removeChildNode(group)
+            self._reindex()
             self.commit()
             print(f"Group {group_name} removed.")
         else:
@@ -415,6 +332,7 @@ class QGISManager:
         """Remove all groups without layers.
         """
         self.project.layerTreeRoot().removeChildrenGroupWithoutLayers()
+        self._reindex()
         self.commit()
         print("Removed all groups without layers.")
 
@@ -427,18 +345,15 @@ class QGISManager:
         parent_group: The name of the parent group.
         subgroup: The name of the subgroup.
         """
-        if self.project.layerTreeRoot().findGroup(subgroup):
+        if subgroup in self._groups:
             print(f"Error: group {subgroup} already exist.")
             return
-        if self.project.layerTreeRoot().findGroup(parent_group):
-            root = self.project.layerTreeRoot()
-            parent = root.findGroup(parent_group)
-            if parent.findGroup(subgroup):
-                print(f"Error: subgroup {subgroup} is already in {parent_group}.")
-            else:
-                parent.addGroup(subgroup)
-                self.commit()
-                print(f"Subgroup {subgroup} added to parent group {parent_group}.")
+        if parent_group in self._groups:
+            group = self._groups[parent_group].addGroup(subgroup)
+            self._groups[subgroup] = group
+            self._checked.append(group)
+            self.commit()
+            print(f"Subgroup {subgroup} added to parent group {parent_group}.")
         else:
             print(f"Error: Cannot find group {parent_group}.")
 
@@ -451,26 +366,25 @@ class QGISManager:
             layer_name: the name of the layer to be removed
             group_name: if specified, the remove the layer inside this group
         """
-        if self.project.mapLayersByName(layer_name):
-            layer = self.project.mapLayersByName(layer_name)[0]
-            root = self.project.layerTreeRoot()
-            if group_name is None:
-                thelayer = next((l for l in root.children() if l.name()==layer.name()), None)
-                root.removeChildNode(thelayer)
-                self.commit()
-                print(f"Layer {layer_name} removed.")
+        if layer_name in self._layers:
+            layer = self._layers[layer_name]
+            thelayer = self._nodes.get(layer_name)
+            if group_name is not None and group_name not in self._groups:
+                print(f"Error: group {group_name} does not exist.")
+            elif group_name is not None and (thelayer is None or thelayer.parent().name() != group_name):
+                print(f"Error: there isn't a layer {layer_name} in group {group_name}.")
             else:
-                if self.project.layerTreeRoot().findGroup(group_name):
-                    group = root.findGroup(group_name)
-                    if not layer.name() in [g.name() for g in group.children()]:
-                        print(f"Error: there isn't a layer {layer_name} in group {group_name}.")
-                    else:
-                        thelayer = next((l for l in group.children() if l.name()==layer.name()), None)
-                        group.removeChildNode(thelayer)
-                        self.commit()
-                        print(f"Layer {layer_name} in group {group_name} removed.")
+                if thelayer is not None:
+                    self._forget_node(thelayer)
+                    thelayer.parent().removeChildNode(thelayer)
+                    del self._nodes[layer_name]
+                self.project.removeMapLayer(layer.id())
+                del self._layers[layer_name]
+                self.commit()
+                if group_name is None:
+                    print(f"Layer {layer_name} removed.")
                 else:
-                    print(f"Error: group {group_name} does not exist.")
+                    print(f"Layer {layer_name} in group {group_name} removed.")
         else:
             print("Error: The specified name doesn't belong to any layer.")
 
@@ -514,8 +428,10 @@ class QGISManager:
         """Creates the Lizmap configuration file.
         """
 
-        layer = self.project.mapLayersByName("OSM_Standard")[0]
-        self.project.layerTreeRoot().findLayer(layer.id()).setItemVisibilityChecked(True)
+        layer = self._layers["OSM_Standard"]
+        node = self._nodes.get("OSM_Standard", self.project.layerTreeRoot().findLayer(layer.id()))
+        node.setItemVisibilityChecked(True)
+        self._checked.append(node)
         self.commit()
 
         lv = LizmapConfig(self.project)
@@ -681,6 +597,51 @@ class QGISManager:
         return res
 
 
+    def has_layer(self, layer_name):
+        """Check if a layer is in the project.
+
+        Parameters
+        ----------
+        layer_name: The name of the layer.
+
+        Returns
+        ----------
+        bool: True if the layer exists
+        """
+        return layer_name in self._layers
+
+
+    def has_group(self, group_name):
+        """Check if a group is in the project.
+
+        Parameters
+        ----------
+        group_name: The name of the group.
+
+        Returns
+        ----------
+        bool: True if the group exists
+        """
+        return group_name in self._groups
+
+
+    def get_group_layers(self, group_name):
+        """Get the layers in a group and in its subgroups.
+
+        Parameters
+        ----------
+        group_name: The name of the group.
+
+        Returns
+        ----------
+        dict: A dictionary mapping each layer name to the name of the group containing it, empty if the group does not exist
+        """
+        group = self._groups.get(group_name)
+        if group is None:
+            return {}
+        return {l.name(): l.parent().name() for l in group.findLayers()}
+
+
     def get_colors():
         """Get all the color for a color ramp.
 
@@ -691,6 +652,46 @@ class QGISManager:
         return QgsStyle().defaultStyle().colorRampNames()
 
 
+    def create_renderer(self, raster_layer, color="Viridis", num_classes=100, stats=None):
+        """Creates a pseudocolor renderer classifying the first band of a raster layer in quantiles.
+
+        Parameters
+        ----------
+        raster_layer: the QgsRasterLayer object
+        color: the name of the color ramp to apply (default is "Viridis")
+        num_classes: the number of classes (default is 100)
+        stats: (optional) a dictionary with the "min", "max" and quantile "breaks" of the raster, 
+               if not specified the quantiles are computed by QGIS from the band statistics
+
+        Returns
+        ----------
+        QgsSingleBandPseudoColorRenderer: the renderer
+        """
+        if color not in self.color_names:
+            color="Viridis"
+        color_ramp = QgsStyle().defaultStyle().colorRamp(color)
+        if stats is None:
+            renderer = QgsSingleBandPseudoColorRenderer(raster_layer.dataProvider(), 1)
+            renderer.createShader(color_ramp, colorRampType=QgsColorRampShader.Interpolated, 
+                classificationMode=QgsColorRampShader.Quantile, classes=num_classes)
+            return renderer
+
+        # build the classes from the cached breaks
+        breaks = stats["breaks"]
+        ramp_shader = QgsColorRampShader(stats["min"], stats["max"], color_ramp, 
+                                         QgsColorRampShader.Interpolated, QgsColorRampShader.Quantile)
+        ramp_shader.setColorRampItemList([
+            QgsColorRampShader.ColorRampItem(value, color_ramp.color(i / max(len(breaks) - 1, 1)), f"{value:.4g}")
+            for i, value in enumerate(breaks)
+        ])
+        shader = QgsRasterShader(stats["min"], stats["max"])
+        shader.setRasterShaderFunction(ramp_shader)
+        renderer = QgsSingleBandPseudoColorRenderer(raster_layer.dataProvider(), 1, shader)
+        renderer.setClassificationMin(stats["min"])
+        renderer.setClassificationMax(stats["max"])
+        return renderer
+
+
     def get_MinMax(self, raster_layer):
         """Get the min and max values in a raster layer.
 
@@ -709,8 +710,106 @@ class QGISManager:
         return (stats.minimumValue, stats.maximumValue)
 
 
+    def _reindex(self):
+        """Rebuilds the name -> layer, name -> layer tree node and name -> group indexes from the project.
+        """
+        self._layers = {}
+        for layer in self.project.mapLayers().values():
+            self._layers.setdefault(layer.name(), layer)
+        self._nodes = {}
+        self._groups = {}
+        def index_group(group):
+            for child in group.children():
+                if isinstance(child, QgsLayerTreeGroup):
+                    self._groups.setdefault(child.name(), child)
+                    index_group(child)
+                elif isinstance(child, QgsLayerTreeLayer):
+                    self._nodes.setdefault(child.name(), child)
+        index_group(self.project.layerTreeRoot())
+        # nodes which may be visible, see _hide_all()
+        self._checked = []
+        self._all_hidden = False
+
+
+    def _forget_node(self, node):
+        """Drops a node which is going to be removed from the tree from the visible nodes.
+        """
+        self._checked = [n for n in self._checked if n is not node]
+
+
+    def _hide_all(self):
+        """Hides all the nodes of the tree. After the first full pass, only the nodes
+        which may have become visible since then are touched.
+        """
+        if not self._all_hidden:
+            self.project.layerTreeRoot().setItemVisibilityCheckedRecursive(False)
+            self._all_hidden = True
+        else:
+            for node in self._checked:
+                node.setItemVisibilityChecked(False)
+        self._checked = []
+
+
+    def _add_to_tree(self, layer, group=None):
+        """Adds a valid layer to the project and to the layer tree, in group if specified,
+        hiding the other layers and keeping the indexes in sync.
+
+        Returns
+        ----------
+        bool: True if the layer has been added
+        """
+        if group and group not in self._groups:
+            print("Error: the specified group does not exist.")
+            return False
+        if layer.name() in self._nodes:
+            if group:
+                print(f"Error: there is already a layer {layer.name()} in group {group}.")
+            else:
+                print("Error: The name of this layer is already used by another layer.")
+            return False
+        self._hide_all()
+        self.project.addMapLayer(layer, False)
+        if group:
+            node = self._groups[group].addLayer(layer)
+        else:
+            node = self.project.layerTreeRoot().insertLayer(0, layer)
+        self._layers[layer.name()] = layer
+        self._nodes[layer.name()] = node
+        self._checked.append(node)
+        return True
+
+
+    @contextmanager
+    def batch(self):
+        """Defers the project writes done inside the block to a single write at its end,
+        instead of serializing the whole project after each change. Nothing is written
+        if the block raises.
+
+        Example
+        ----------
+        with qgis_manager.batch():
+            qgis_manager.create_group('rasters')
+            qgis_manager.add_PostGIS_raster_layer(...)
+            qgis_manager.move_layer_in_group('rasters', ...)
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+        # reached only if the block completed, a failed one leaves the project on disk as it was
+        if self._batch_depth == 0 and self._dirty:
+            self.commit()
+
+
     def commit(self):
+        """Writes the project to disk, or marks it to be written if inside a batch() block.
+        """
+        if self._batch_depth > 0:
+            self._dirty = True
+            return
         self.project.write()
+        self._dirty = False
         print("Project commited.")
 
 
@@ -3,21 +3,66 @@ from flask_sqlalchemy import SQLAlchemy
 import json
 from flask_restful import Api
 from flask_login import LoginManager
-from sqlalchemy import create_engine, MetaData
+from sqlalchemy import MetaData, event
+from sqlalchemy.pool import NullPool
+import multiprocessing
+import fcntl
 import os
 
 
 app = Flask(__name__)
 app.config.from_file("./config.json", json.load)
 
-engine = create_engine(app.config.get("SQLALCHEMY_DATABASE_URI"), pool_recycle=3600)
+def get_engine_options():
+	"""Builds the options of the database engine from the configuration: the pool settings
+	(SQLALCHEMY_ENGINE_OPTIONS), the statement timeout (STATEMENT_TIMEOUT, in ms) and, with PGBOUNCER,
+	no pooling in the app since connections are pooled by pgbouncer in transaction mode.
+	"""
+	options = dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+	if app.config.get("PGBOUNCER", False):
+		for cur_option in ("pool_size", "max_overflow", "pool_timeout", "pool_recycle", "pool_pre_ping"):
+			options.pop(cur_option, None)
+		options["poolclass"] = NullPool
+	elif app.config.get("STATEMENT_TIMEOUT"):
+		# pgbouncer does not forward startup options, see set_statement_timeout
+		connect_args = dict(options.get("connect_args", {}))
+		connect_args["options"] = f"-c statement_timeout={int(app.config['STATEMENT_TIMEOUT'])}"
+		options["connect_args"] = connect_args
+	return options
+
+
 meta = MetaData()
 
+# a single engine, and pool, for the session and the DDL
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = get_engine_options()
 db = SQLAlchemy(app, metadata=meta)
+engine = db.engine
+
+
+@event.listens_for(engine, "connect")
+def set_session_statement_timeout(dbapi_conn, connection_record):
+	# also covers the statements run outside a transaction; behind pgbouncer the setting stays on
+	# whichever server connection runs it, all of them get the same value from the app
+	if app.config.get("PGBOUNCER", False) and app.config.get("STATEMENT_TIMEOUT"):
+		cursor = dbapi_conn.cursor()
+		cursor.execute(f"SET statement_timeout = {int(app.config['STATEMENT_TIMEOUT'])}")
+		cursor.close()
+		dbapi_conn.commit()
+
+
+@event.listens_for(engine, "begin")
+def set_statement_timeout(conn):
+	# behind pgbouncer, a server connection is bound to the client only for a transaction
+	if app.config.get("PGBOUNCER", False) and app.config.get("STATEMENT_TIMEOUT"):
+		conn.exec_driver_sql(f"SET LOCAL statement_timeout = {int(app.config['STATEMENT_TIMEOUT'])}")
+
+
 api = Api(app)
 login_manager = LoginManager(app)
 
 
+from .migrations import migrate
+
 from .DBManager import DBManager
 db_manager = DBManager()
 
@@ -33,67 +78,186 @@ app.register_blueprint(_api, url_prefix=BASE)
 
 from pignoletto.resources import (
 	DroneAcquisition,
-	DroneAcquisitions
+	DroneAcquisitions,
+	DroneAcquisitionsBatch,
+	AcquisitionsExport,
+	RasterImports,
+	VectorImports,
+	VectorLayers,
+	ImportJob
 )
 api.add_resource(DroneAcquisition, BASE + "/drone")
 api.add_resource(DroneAcquisitions, BASE + "/drones")
+api.add_resource(DroneAcquisitionsBatch, BASE + "/drones/batch")
+api.add_resource(AcquisitionsExport, BASE + "/export/<string:dataset>")
+api.add_resource(RasterImports, BASE + "/rasters")
+api.add_resource(VectorImports, BASE + "/vectors")
+api.add_resource(VectorLayers, BASE + "/vectors/layers")
+api.add_resource(ImportJob, BASE + "/rasters/jobs/<string:job_id>", BASE + "/vectors/jobs/<string:job_id>")
+
+def get_project_path():
+	lizmap_path = "./lizmap/instances/"
+	os.makedirs(os.path.join(lizmap_path, "pignoletto"), exist_ok=True)
+	return os.path.join(lizmap_path, "pignoletto/pignoletto.qgs")
+
+
+def get_project_layers():
+	"""Creates the missing views and lists the layers the QGIS project has to contain.
+
+	Returns
+	-------
+	list : [group, subgroup, layer name, table name, layer type] for each layer
+	"""
+	# all rasters
+	layers = [['rasters', None, cur_raster_name, cur_raster_table, 'raster']
+				for cur_raster_id, cur_raster_name, cur_raster_table in db_manager.get_rasters()]
+	# all imported vector layers
+	layers += [['vectors', None, cur_vector_name, cur_vector_table, 'vector']
+				for cur_vector_id, cur_vector_name, cur_vector_table in db_manager.get_vectors()]
+	views = db_manager.create_views(materialized=app.config.get("MATERIALIZED_LAYER_VIEWS", False), only_missing=True)
+	for cur_group in views.keys():
+		for cur_element, cur_view in views[cur_group].items():
+			# estimated views are nested by model, each model is a subgroup
+			if isinstance(cur_view, dict):
+				for cur_var_view in cur_view.values():
+					layers.append([cur_group, cur_element, cur_var_view, cur_var_view, 'vector'])
+			else:
+				layers.append([cur_group, None, cur_element, cur_view, 'vector'])
+	return layers
+
 
 def create_views():
+	"""Synchronizes the QGIS project and the Lizmap configuration with the database.
+	Only the missing views are created and only the layers which changed since the 
+	last synchronization are added to or removed from the project.
+	"""
+	final_path = get_project_path()
+	state_path = final_path + ".sync.json"
+
+	layers = get_project_layers()
+	# a raster imported again keeps its table, its version tells whether its renderer is outdated
+	raster_versions = {cur_table: db_manager.get_raster_version(cur_table) 
+						for _, _, _, cur_table, cur_type in layers if cur_type == 'raster'}
+	state = {"layers": layers, "raster_versions": raster_versions}
+	# nothing to do if the project reflects the current database state
+	previous = {}
+	if os.path.isfile(final_path) and os.path.isfile(final_path + ".cfg") and os.path.isfile(state_path):
+		with open(state_path) as f:
+			previous = json.load(f)
+		if previous == state:
+			print("QGIS project already up to date.")
+			return
+	previous_versions = previous.get("raster_versions", {}) if isinstance(previous, dict) else {}
+	outdated = {cur_table for cur_table, cur_version in raster_versions.items()
+				if previous_versions.get(cur_table, cur_version) != cur_version}
+
 	from .QGISManager import QGISManager
-	lizmap_path = "./lizmap/instances/"
-	if os.path.isdir(os.path.join(lizmap_path, "pignoletto")):
-		final_path = os.path.join(lizmap_path, "pignoletto/pignoletto.qgs")
-	else:
-		os.makedirs(os.path.join(lizmap_path, "pignoletto"))
-		final_path = os.path.join(lizmap_path, "pignoletto/pignoletto.qgs")
 	qgis_manager = QGISManager(final_path)
+	connection = dict(
+		host_name = app.config.get("IP"), 
+		port = app.config.get("PORT"), 
+		db_name = app.config.get("DB_NAME"), 
+		username = app.config.get("USERNAME"),
+		password = app.config.get("PASSWORD"), 
+		schema = app.config.get("SCHEMA")
+	)
 
-	# view all rasters
-	qgis_manager.create_group('rasters')
-	rasters = db_manager.get_rasters()
-	# for each raster
-	for cur_raster_id, cur_raster_name, cur_raster_table in rasters:
-		# create layer
-		qgis_manager.add_PostGIS_raster_layer(
-			host_name = app.config.get("IP"), 
-			port = app.config.get("PORT"), 
-			db_name = app.config.get("DB_NAME"), 
-			username = app.config.get("USERNAME"),
-			password = app.config.get("PASSWORD"), 
-			schema = app.config.get("SCHEMA"),
-			table_name = cur_raster_table,
-			num_classes=100, color="Viridis",
-			layer_name=cur_raster_name, pk=None, filter=None, group=None
-		)
-		# move in subgroup
-		qgis_manager.move_layer_in_group('rasters', cur_raster_name) 
-
-	views = db_manager.create_views()
-	# generate layers corresponding to created views
-	for cur_group in views.keys():
-		# create group
-		qgis_manager.create_group(cur_group)
-		# for each element
-		for cur_element in views[cur_group]:
-			# TODO: check if it's a layer to add or a subgroup
-			qgis_manager.add_PostGIS_vector_layer(
-						host_name = app.config.get("IP"), 
-						port = app.config.get("PORT"), 
-						db_name = app.config.get("DB_NAME"), 
-						username = app.config.get("USERNAME"),
-						password = app.config.get("PASSWORD"), 
-						schema = app.config.get("SCHEMA"),
-						table_name = views[cur_group][cur_element],
-						geomColumn = "coords",
-						layer_name = cur_element,
-						pk='id', filter=None, group=None)
-			# move in group
-			qgis_manager.move_layer_in_group(cur_group, cur_element)
-			
-	# Set WFS in order to use lizmap plugins
-	qgis_manager.set_WFSCapabilities()
-
-	# create lizmap configuration
-	qgis_manager.create_Lizmap_configuration(tooltip=True, formfilter=True, attributeTable=True)
-
-create_views()
+	# write the project once, at the end of the synchronization
+	with qgis_manager.batch():
+		# remove the layers which are not in the database anymore
+		expected = {cur_group: set() for cur_group, _, _, _, _ in layers}
+		for cur_group, _, cur_layer, _, _ in layers:
+			expected[cur_group].add(cur_layer)
+		for cur_group in set(expected) | {'rasters', 'vectors', 'lab_acquisition', 'estimated'}:
+			for cur_layer, cur_parent in qgis_manager.get_group_layers(cur_group).items():
+				if cur_layer not in expected.get(cur_group, set()):
+					qgis_manager.remove_layer(cur_layer, cur_parent)
+
+		# add the new ones
+		for cur_group, cur_subgroup, cur_layer, cur_table, cur_type in layers:
+			if qgis_manager.has_layer(cur_layer):
+				if cur_table not in outdated:
+					continue
+				# add it again, with the renderer of the new statistics
+				qgis_manager.remove_layer(cur_layer)
+			# create group and subgroup
+			if not qgis_manager.has_group(cur_group):
+				qgis_manager.create_group(cur_group)
+			if cur_subgroup is not None and not qgis_manager.has_group(cur_subgroup):
+				qgis_manager.add_subgroup(cur_group, cur_subgroup)
+			# create layer
+			if cur_type == 'raster':
+				qgis_manager.add_PostGIS_raster_layer(
+					**connection,
+					table_name = cur_table,
+					num_classes=100, color="Viridis",
+					layer_name=cur_layer, pk=None, filter=None, group=cur_subgroup or cur_group,
+					stats=db_manager.get_raster_stats(cur_table, num_classes=100)
+				)
+			else:
+				qgis_manager.add_PostGIS_vector_layer(
+					**connection,
+					table_name = cur_table,
+					geomColumn = "coords",
+					layer_name = cur_layer,
+					pk='id', filter=None, group=cur_subgroup or cur_group
+				)
+
+		# Set WFS in order to use lizmap plugins
+		qgis_manager.set_WFSCapabilities()
+
+		# create lizmap configuration
+		qgis_manager.create_Lizmap_configuration(tooltip=True, formfilter=True, attributeTable=True)
+
+	# save the synchronized state
+	with open(state_path, "w") as f:
+		json.dump(state, f)
+
+
+def sync_project():
+	"""Runs create_views holding the lock of the project, so that only one process writes it at a time."""
+	# the later synchronizations catch up the changes made meanwhile
+	with open(get_project_path() + ".lock", "w") as lock:
+		fcntl.flock(lock, fcntl.LOCK_EX)
+		with app.app_context():
+			create_views()
+
+
+# the pools inherited by the forked sync processes, referenced so that their connections are neither
+# reused nor closed (by the garbage collector) in the child, since their sockets belong to the parent
+inherited_pools = []
+
+
+def _create_views_job():
+	inherited_pools.append(engine.pool)
+	engine.pool = engine.pool.recreate()
+	sync_project()
+
+
+def start_create_views():
+	"""Runs create_views in a background process, so that neither the app start-up
+	nor the request triggering it wait for the QGIS project to be synchronized.
+	"""
+	process = multiprocessing.get_context("fork").Process(target=_create_views_job, daemon=True)
+	process.start()
+	return process
+
+
+def start():
+	"""Starts the web app: applies the missing migrations and synchronizes the QGIS project in background.
+	Called by the entry point of the server (run.py), not on import, so that the CLI commands do not do it.
+	"""
+	migrate(engine)
+	start_create_views()
+
+
+@app.cli.command("migrate")
+def migrate_command():
+	"""Applies the missing schema migrations."""
+	migrate(engine)
+
+
+@app.cli.command("create-views")
+def create_views_command():
+	"""Synchronizes the QGIS project with the database."""
+	sync_project()
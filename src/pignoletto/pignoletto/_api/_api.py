@@ -23,6 +23,6 @@ def api_login():
     if not user.role[0].type == "admin":
         return jsonify({"Error": "Sorry, you don't have the rights to access"}, 400)
     if check_password_hash(user.password, auth.password):
-        token = jwt.encode({"id": user.id, "exp": datetime.datetime.utcnow() + datetime.timedelta(minutes=30)}, current_app.config["SECRET_KEY"], algorithm="HS256")
+        token = jwt.encode({"id": user.id, "role": user.role[0].type, "exp": datetime.datetime.utcnow() + datetime.timedelta(minutes=30)}, current_app.config["SECRET_KEY"], algorithm="HS256")
         return jsonify({"token": token.decode('UTF-8')}, 200)
     return jsonify({"Error": "Invalid password"}, 400)
@@ -4,6 +4,9 @@ from flask_restful import abort
 from werkzeug.security import check_password_hash, generate_password_hash
 from flask_login import login_user, login_required, logout_user, current_user
 import sqlalchemy as sa
+from sqlalchemy.orm import joinedload
+from collections import OrderedDict
+from datetime import datetime
 import zipfile
 import os
 
@@ -12,7 +15,6 @@ from pignoletto.models import (
     User_model,
     Role_model,
     site,
-    variable,
     drone_acq,
     images,
     model
@@ -25,7 +27,7 @@ def allowed_file(filename, file_type):
         Parameters
         ----------
         filename : A file name
-        file_type: A string between: 'image', 'py', 'csv'
+        file_type: A string between: 'image', 'py', 'csv' (acquisition tables, also as Parquet or Arrow)
 
         Returns
         -------
@@ -36,19 +38,68 @@ def allowed_file(filename, file_type):
     if file_type == "image":
         ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif','JPEG', 'tif', 'tiff'])
     elif file_type == "csv":
-        ALLOWED_EXTENSIONS = set(["csv"])
+        ALLOWED_EXTENSIONS = set(["csv", "parquet", "arrow", "feather"])
     elif file_type == "py":
         ALLOWED_EXTENSIONS = set(["py"])
     return '.' in filename and \
         filename.rsplit('.', 1)[1] in ALLOWED_EXTENSIONS
 
 
+# How array columns (hyperspectral, gamma) are returned to the tables
+ARRAY_MODES = ("full", "truncate", "exclude")
+
+
+def parse_datatables_args(args):
+    """Parses the parameters sent by a DataTables client in server-side processing mode.
+
+        Parameters
+        ----------
+        args: the request arguments
+
+        Returns
+        -------
+        dict : the draw counter, offset and limit of the page, the ordering column and direction,
+               the column searches, the time range and how array columns have to be returned
+        
+        """
+    columns = []
+    i = 0
+    while f"columns[{i}][data]" in args:
+        columns.append(args[f"columns[{i}][data]"])
+        i += 1
+
+    order_col = args.get("order[0][column]", type=int)
+    order_dir = "desc" if args.get("order[0][dir]") == "desc" else "asc"
+
+    def to_datetime(value):
+        try:
+            return datetime.fromisoformat(value.replace("Z", "+00:00")).replace(tzinfo=None)
+        except (AttributeError, ValueError):
+            return None
+
+    return {
+        "draw": args.get("draw", 0, type=int),
+        "start": max(args.get("start", 0, type=int), 0),
+        "length": args.get("length", -1, type=int),
+        "order": (columns[order_col], order_dir) if order_col is not None and order_col < len(columns) else None,
+        "search": {col: args[f"columns[{i}][search][value]"] for i, col in enumerate(columns)
+                   if args.get(f"columns[{i}][search][value]")},
+        "min": to_datetime(args.get("min")),
+        "max": to_datetime(args.get("max")),
+        "arrays": args.get("arrays", "full") if args.get("arrays") in ARRAY_MODES else "full",
+        "arrays_length": max(args.get("arrays_length", 64, type=int), 1)
+    }
+
+
+
 _frontend = Blueprint('_frontend', __name__,
                     template_folder='./templates',
                     static_folder='./static')
 
 
 from pignoletto import db_manager
+from pignoletto.DBManager import LAB_PIVOT
+from pignoletto.exporters import EXPORT_FORMATS, stream_json_rows
 
 
 @login_manager.unauthorized_handler
@@ -58,7 +109,8 @@ def unauthorized_callback():
 
 @login_manager.user_loader
 def load_user(id):
-   return User_model.query.get(int(id))
+   # roles are loaded with the user, they are read by every page
+   return User_model.query.options(joinedload(User_model.role)).get(int(id))
 
 
 @_frontend.post("/upload_model")
@@ -190,7 +242,12 @@ def upload_labAcq_csv():
             return render_template("labAcq_table.html", title=current_user.username, tipo=current_user.role[0].type, header=get_labAcq_header())
 
         # Call the DBManager
-        db_manager.insert_lab_acquisition(file)
+        report = db_manager.insert_lab_acquisition(file, chunk_size=app.config.get("INGEST_CHUNK_SIZE"),
+                                                   file_format=file.filename.rsplit('.', 1)[1])
+        flash(f"{report['inserted']} acquisitions uploaded correctly.", category='success')
+        # new variables may require new layers
+        from pignoletto import start_create_views
+        start_create_views()
 
         return render_template("labAcq_table.html", title=current_user.username, tipo=current_user.role[0].type, header=get_labAcq_header())
 
@@ -211,7 +268,13 @@ def upload_droneAcq_csv():
             return render_template("droneAcq_table.html", title=current_user.username, tipo=current_user.role[0].type, header=get_droneAcq_header())
 
         # Call the DBManager
-        db_manager.insert_drone_acquisition(file)
+        report = db_manager.insert_drone_acquisition(file, chunk_size=app.config.get("INGEST_CHUNK_SIZE"),
+                                                     file_format=file.filename.rsplit('.', 1)[1])
+        if report['rejected_count'] > 0:
+            flash(f"{report['inserted']} acquisitions uploaded, {report['rejected_count']} rejected "
+                  f"(first: row {report['rejected'][0]['row']}, {report['rejected'][0]['reason']})", category='warning')
+        else:
+            flash(f"{report['inserted']} acquisitions uploaded correctly.", category='success')
 
         return render_template("droneAcq_table.html", title=current_user.username, tipo=current_user.role[0].type, header=get_droneAcq_header())
 
@@ -219,27 +282,124 @@ def upload_droneAcq_csv():
 @_frontend.get("/get_lab_acquisitions")
 @login_required
 def get_lab_acquisitions():
-    pivoting = get_labAcq_query()
-    res_piv = db.session.execute(pivoting).all()
+    if "draw" not in request.args:
+        result = db_manager.stream_query(get_labAcq_query())
+        return flask.Response(flask.stream_with_context(stream_json_rows(
+                                result, app.config.get("EXPORT_BATCH_SIZE", 10000))),
+                              mimetype="application/json")
+
+    dt = parse_datatables_args(request.args)
+    # whitelist of the columns which can be used for ordering and search
+    orderable = {"id": "id", "sito": "sito", "time": "time"}
+    searchable = {"id": "id", "sito": "sito"}
+    where, params = [], {}
+    for col, value in dt["search"].items():
+        if col in searchable:
+            where.append(f"{searchable[col]} ILIKE '%' || :search_{col} || '%'")
+            params[f"search_{col}"] = value
+    if dt["min"] is not None:
+        where.append("time >= :min_time")
+        params["min_time"] = dt["min"]
+    if dt["max"] is not None:
+        where.append("time <= :max_time")
+        params["max_time"] = dt["max"]
+    order_by = f"{orderable[dt['order'][0]]} {dt['order'][1]}" if dt["order"] and dt["order"][0] in orderable else None
+
+    query = get_labAcq_query(where=where, order_by=order_by,
+                             limit=dt["length"] if dt["length"] > 0 else None, offset=dt["start"],
+                             arrays=dt["arrays"], arrays_length=dt["arrays_length"])
+    res_piv = db.session.execute(query, params).all()
+
+    # the filtered rows are only counted, without reading the spectra
+    records_filtered = db.session.execute(sa.text(f"""
+        SELECT COUNT(*) FROM {LAB_PIVOT} {"WHERE " + " AND ".join(where) if where else ""}
+    """), params).scalar()
+    if where:
+        records_total = db.session.execute(sa.text(f"SELECT COUNT(*) FROM {LAB_PIVOT}")).scalar()
+    else:
+        records_total = records_filtered
+    return {
+        "draw": dt["draw"],
+        "recordsTotal": records_total,
+        "recordsFiltered": records_filtered,
+        "data": [dict(r._mapping) for r in res_piv]
+    }
 
-    result = {"data": list()}
-    for r in res_piv:
-        result["data"].append({k:r[k] for k in res_piv[0].keys()})
 
-    return result
+@_frontend.get("/export_acquisitions/<string:dataset>")
+@login_required
+def export_acquisitions(dataset):
+    """Streams all the lab ('lab') or drone ('drone') acquisitions as Parquet, CSV, NDJSON or GeoJSON."""
+    if dataset not in ("lab", "drone"):
+        abort(404, message=f"Dataset {dataset} not found.")
+    file_format = request.args.get("format", "csv")
+    if file_format not in EXPORT_FORMATS:
+        abort(400, message=f"Format {file_format} not supported.")
+    writer, mimetype, extension = EXPORT_FORMATS[file_format]
+    result = db_manager.stream_query(db_manager.get_export_query(dataset, geometry=file_format == "geojson"))
+    return flask.Response(flask.stream_with_context(writer(result, app.config.get("EXPORT_BATCH_SIZE", 10000))),
+                          mimetype=mimetype,
+                          headers={"Content-Disposition": f"attachment; filename={dataset}_acquisitions.{extension}"})
 
 
 @_frontend.get("/get_drone_acquisitions")
 @login_required
 def get_drone_acquisitions():
-    drones = db.session.query(site.c.name.label("sito"), drone_acq.c.lat.label("latitude"), drone_acq.c.lon.label("longitude"),\
-        drone_acq.c.time, drone_acq.c.start_acq_time.label("start acq timestamp"), drone_acq.c.stop_acq_time.label("stop acq timestamp"),\
-        drone_acq.c.mission, drone_acq.c.path, drone_acq.c.acquisition, drone_acq.c.z, drone_acq.c.start_band.label("bandaIniziale"),\
-        drone_acq.c.stop_band.label("bandaFinale"), drone_acq.c.gamma).join(site).all()
-    result = {"data": list()}
-    for d in drones:
-        result["data"].append({k:d[k] for k in drones[0].keys() if not k == "coords"})
-    return result
+    columns = get_droneAcq_columns()
+    if "draw" not in request.args:
+        result = db_manager.stream_query(sa.select(*columns.values()).select_from(drone_acq.join(site)))
+        return flask.Response(flask.stream_with_context(stream_json_rows(
+                                result, app.config.get("EXPORT_BATCH_SIZE", 10000))),
+                              mimetype="application/json")
+
+    dt = parse_datatables_args(request.args)
+    # truncate or exclude the gamma spectra
+    if dt["arrays"] == "truncate":
+        columns["gamma"] = drone_acq.c.gamma[1:dt["arrays_length"]].label("gamma")
+    elif dt["arrays"] == "exclude":
+        columns["gamma"] = sa.null().label("gamma")
+
+    # whitelist of the columns which can be used for ordering and search
+    orderable = {"sito": site.c.name, "time": drone_acq.c.time,
+                 "start acq timestamp": drone_acq.c.start_acq_time, "stop acq timestamp": drone_acq.c.stop_acq_time}
+    searchable = {"sito": site.c.name, "mission": drone_acq.c.mission,
+                  "path": drone_acq.c.path, "acquisition": drone_acq.c.acquisition}
+
+    filters = []
+    for col, value in dt["search"].items():
+        if col in searchable:
+            filters.append(searchable[col].ilike(f"%{value}%"))
+    if dt["min"] is not None:
+        filters.append(drone_acq.c.time >= dt["min"])
+    if dt["max"] is not None:
+        filters.append(drone_acq.c.time <= dt["max"])
+    if dt["order"] and dt["order"][0] in orderable:
+        order_col = orderable[dt["order"][0]]
+        order_by = [order_col.desc() if dt["order"][1] == "desc" else order_col.asc(), drone_acq.c.id]
+    else:
+        order_by = [drone_acq.c.id]
+
+    # the filtered rows are only counted, without reading the spectra
+    records_filtered = db.session.query(sa.func.count()).select_from(drone_acq).join(site).filter(*filters).scalar()
+    # ids of the page, then the columns, and the spectra, of these rows only
+    page = sa.select(drone_acq.c.id).select_from(drone_acq.join(site)).where(*filters)\
+             .order_by(*order_by).offset(dt["start"])
+    if dt["length"] > 0:
+        page = page.limit(dt["length"])
+    page = page.subquery()
+    drones = db.session.query(*columns.values()).select_from(drone_acq).join(site)\
+                .join(page, page.c.id == drone_acq.c.id).order_by(*order_by).all()
+
+    if filters:
+        records_total = db.session.query(sa.func.count()).select_from(drone_acq).join(site).scalar()
+    else:
+        records_total = records_filtered
+    return {
+        "draw": dt["draw"],
+        "recordsTotal": records_total,
+        "recordsFiltered": records_filtered,
+        "data": [dict(d._mapping) for d in drones]
+    }
 
 
 @_frontend.get("/drone_acquisitions") 
@@ -323,55 +483,87 @@ def get_drone_acq_keys():
     return flask.jsonify(get_droneAcq_header())
 
 
+def get_droneAcq_columns():
+    return OrderedDict([
+        ("sito", site.c.name.label("sito")),
+        ("latitude", drone_acq.c.lat.label("latitude")),
+        ("longitude", drone_acq.c.lon.label("longitude")),
+        ("time", drone_acq.c.time),
+        ("start acq timestamp", drone_acq.c.start_acq_time.label("start acq timestamp")),
+        ("stop acq timestamp", drone_acq.c.stop_acq_time.label("stop acq timestamp")),
+        ("mission", drone_acq.c.mission),
+        ("path", drone_acq.c.path),
+        ("acquisition", drone_acq.c.acquisition),
+        ("z", drone_acq.c.z),
+        ("bandaIniziale", drone_acq.c.start_band.label("bandaIniziale")),
+        ("bandaFinale", drone_acq.c.stop_band.label("bandaFinale")),
+        ("gamma", drone_acq.c.gamma)
+    ])
+
+
 def get_droneAcq_header():
-    header = db.session.query(site.c.name.label("sito"), drone_acq.c.lat.label("latitude"), drone_acq.c.lon.label("longitude"),\
-        drone_acq.c.time, drone_acq.c.start_acq_time.label("start acq timestamp"), drone_acq.c.stop_acq_time.label("stop acq timestamp"),\
-        drone_acq.c.mission, drone_acq.c.path, drone_acq.c.acquisition, drone_acq.c.z, drone_acq.c.start_band.label("bandaIniziale"),\
-        drone_acq.c.stop_band.label("bandaFinale"), drone_acq.c.gamma).join(site).limit(1).first()
-    if not header:
-        header = {"No data available at the moment...":[]}
-    return [elem for elem in header.keys() if not elem == "coords"]
+    # the columns are fixed, only whether there are data is asked (and cached) by the DBManager
+    if not db_manager.has_drone_acquisitions():
+        return ["No data available at the moment..."]
+    return [elem for elem in get_droneAcq_columns().keys() if not elem == "coords"]
 
 
 def get_labAcq_header():
-    query = get_labAcq_query(only_header=True)
-    header = db.session.execute(query).first()
+    header = db_manager.get_lab_pivot_columns()
 
     if not header:
-        header = {"No data available at the moment...":[]}
+        header = ["No data available at the moment..."]
 
-    return [elem for elem in header.keys()]
+    return header
 
 
-def get_labAcq_query(only_header=False):
-    vars = [var[0] for var in db.session.query(variable.c.name).all()]
+def get_labAcq_query(where=None, order_by=None, limit=None, offset=0, arrays="full", arrays_length=64):
+    """Builds the query reading the laboratory acquisitions, with their measures pivoted into columns,
+    from the materialized pivot maintained by the DBManager.
 
-    query = """
-    SELECT lab_acquisition.id, site.name AS sito, lab_acquisition.lat AS latitude, lab_acquisition.lon AS longitude, 
-            lab_acquisition.time, lab_acquisition.nlab AS Nlab, lab_acquisition.nfield AS Ncampo, 
-            lab_acquisition.depth AS depth_cm, lab_acquisition.gamma,
-    """
-    for var in vars:
-        query += f"MAX(measure.value) FILTER (WHERE variable.name = '{var}') as {var},"
-    query += """lab_acquisition.hyperspectral"""
-    if only_header:
-        query += """
-        FROM lab_acquisition
-                LEFT OUTER JOIN site ON site.id = lab_acquisition.site
-                LEFT OUTER JOIN measure ON lab_acquisition.id = measure.id_lab_acquisition 
-                LEFT OUTER JOIN variable ON variable.id = measure.id_variable
-            GROUP BY lab_acquisition.id, sito
-            ORDER BY lab_acquisition.id, sito
-            LIMIT 1
+        Parameters
+        ----------
+        where: a list of SQL conditions on the pivot columns (default is None)
+        order_by: an SQL ordering expression (default is the acquisition id)
+        limit: the page length (default is None, i.e. all rows)
+        offset: the page offset (default is 0)
+        arrays: one between 'full', 'truncate' and 'exclude' for the hyperspectral and gamma columns
+        arrays_length: the number of elements kept when arrays is 'truncate'
+
+        Returns
+        -------
+        TextClause : the query
+        
+        """
+    columns = []
+    for col in db_manager.get_lab_pivot_columns():
+        if col in ("gamma", "hyperspectral") and arrays == "exclude":
+            columns.append(f"NULL::float[] AS {col}")
+        elif col in ("gamma", "hyperspectral") and arrays == "truncate":
+            columns.append(f"{col}[1:{int(arrays_length)}] AS {col}")
+        else:
+            columns.append(col)
+
+    where = "WHERE " + " AND ".join(where) if where else ""
+    order_by = f"{order_by + ', ' if order_by else ''}id"
+    if limit is None and not offset:
+        query = f"""
+        SELECT {", ".join(columns)}
+        FROM {LAB_PIVOT}
+        {where}
+        ORDER BY {order_by}
         """
     else:
-        query += """
-        FROM lab_acquisition
-                LEFT OUTER JOIN site ON site.id = lab_acquisition.site
-                LEFT OUTER JOIN measure ON lab_acquisition.id = measure.id_lab_acquisition 
-                LEFT OUTER JOIN variable ON variable.id = measure.id_variable
-            GROUP BY lab_acquisition.id, sito
-            ORDER BY lab_acquisition.id, sito
+        # ids of the page, then the columns, and the spectra, of these rows only
+        query = f"""
+        SELECT {", ".join(columns)}
+        FROM {LAB_PIVOT} JOIN (
+            SELECT id FROM {LAB_PIVOT}
+            {where}
+            ORDER BY {order_by}
+            {f"LIMIT {int(limit)}" if limit is not None else ""} OFFSET {int(offset)}
+        ) page USING (id)
+        ORDER BY {order_by}
         """
     return sa.text(query)
 
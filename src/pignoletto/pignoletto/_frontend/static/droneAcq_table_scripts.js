@@ -1,22 +1,4 @@
 var minDate, maxDate;
-    // Custom filtering function which will search data in column four between two values
-    $.fn.dataTable.ext.search.push(
-        function(settings, data, dataIndex) {
-            var min = minDate.val();
-            var max = maxDate.val();
-            var date = new Date(data[3]);
-    
-            if (
-                (min === null && max === null) ||
-                (min === null && date <= max) ||
-                (min <= date && max === null) ||
-                (min <= date && date <= max)
-            ) {
-                return true;
-            }
-            return false;
-        }
-    );
     $(document).ready(function () {
         // Create date inputs
         minDate = new DateTime($('#min'), {
@@ -39,12 +21,20 @@ var minDate, maxDate;
   
         let col = keys.map(test);
         function test(value) {
-            return {data: value, orderable: (value=="sito" || value=="time" || value=="start_acq_time" || value=="stop_acq_time")?true:false};
+            return {data: value, orderable: (value=="sito" || value=="time" || value=="start acq timestamp" || value=="stop acq timestamp")?true:false};
         }
 
         var table = $('#data').DataTable({
-            ajax: "/pignoletto/get_drone_acquisitions",
-            serverSide: false,
+            ajax: {
+                url: "/pignoletto/get_drone_acquisitions",
+                // Time range and array handling are applied server-side
+                data: function(d) {
+                    d.min = minDate.val() ? moment(minDate.val()).format("YYYY-MM-DDTHH:mm:ss") : "";
+                    d.max = maxDate.val() ? moment(maxDate.val()).format("YYYY-MM-DDTHH:mm:ss") : "";
+                    d.arrays = "truncate";
+                }
+            },
+            serverSide: true,
             columns: col,
             scrollY: '65vh',
             scrollX: true,
@@ -53,9 +43,11 @@ var minDate, maxDate;
             dom: 'Blrtip',  // Blfrtip -> to show the general filter tab
             buttons: [
                 {
-                    extend: 'csv',
+                    // the table holds only the current page, the whole table is exported by the server
                     text: 'Download data as CSV',
-                    filename: 'Drone_acquisitions'
+                    action: function() {
+                        window.location.href = "/pignoletto/export_acquisitions/drone?format=csv";
+                    }
                 }
             ]
         });
@@ -0,0 +1,75 @@
+import time
+import sqlalchemy as sa
+from sqlalchemy.orm import joinedload
+
+from pignoletto import db, app
+from .models import User_model
+
+
+class Principal(object):
+    """The verified identity of a user, detached from the session so that it can be cached."""
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.verified = user.verified
+        self.roles = tuple(role.type for role in user.role)
+
+    def has_role(self, role):
+        return role in self.roles
+
+
+# user id -> (expiration time, principal), shared by all the requests of the process
+principals = {}
+
+
+def get_principal(user_id):
+    """Gets the principal of a user, from the cache if loaded less than PRINCIPAL_CACHE_TTL seconds ago.
+
+    Returns
+    -------
+    Principal : the principal, None if the user does not exist
+    """
+    now = time.monotonic()
+    cached = principals.get(user_id)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    # user and roles in one query
+    user = db.session.query(User_model).options(joinedload(User_model.role)).filter_by(id=user_id).first()
+    if user is None:
+        principals.pop(user_id, None)
+        return None
+    principal = Principal(user)
+    principals[user_id] = (now + app.config.get("PRINCIPAL_CACHE_TTL", 60), principal)
+    return principal
+
+
+def invalidate_principal(user_id=None):
+    """Removes a user, or all users if user_id is None, from the principal cache."""
+    if user_id is None:
+        principals.clear()
+    else:
+        principals.pop(user_id, None)
+
+
+# changes of users and of their roles invalidate the cache once committed
+def _collect_user(mapper, connection, target):
+    db.session.info.setdefault('invalidate_principals', set()).add(target.id)
+
+def _collect_role_change(target, value, initiator):
+    db.session.info.setdefault('invalidate_principals', set()).add(target.id)
+
+def _invalidate_committed(session):
+    for user_id in session.info.pop('invalidate_principals', ()):
+        # new users are not cached yet
+        if user_id is not None:
+            invalidate_principal(user_id)
+
+def _discard_rolled_back(session):
+    session.info.pop('invalidate_principals', None)
+
+sa.event.listen(User_model, 'after_update', _collect_user)
+sa.event.listen(User_model, 'after_delete', _collect_user)
+sa.event.listen(User_model.role, 'append', _collect_role_change)
+sa.event.listen(User_model.role, 'remove', _collect_role_change)
+sa.event.listen(db.session, 'after_commit', _invalidate_committed)
+sa.event.listen(db.session, 'after_rollback', _discard_rolled_back)
@@ -0,0 +1,195 @@
+import io
+import csv
+import json
+from datetime import date, datetime
+from decimal import Decimal
+import pyarrow as pa
+import pyarrow.parquet as pq
+from flask import json as flask_json
+
+
+# PostgreSQL type oids -> arrow types, the columns of the other types are exported as text
+ARROW_TYPES = {
+    16: pa.bool_(),                     # bool
+    20: pa.int64(),                     # int8
+    21: pa.int64(),                     # int2
+    23: pa.int64(),                     # int4
+    700: pa.float64(),                  # float4
+    701: pa.float64(),                  # float8
+    1700: pa.float64(),                 # numeric
+    1082: pa.date32(),                  # date
+    1114: pa.timestamp('us'),           # timestamp
+    1184: pa.timestamp('us', tz='UTC'), # timestamptz
+    1005: pa.list_(pa.int64()),         # int2[]
+    1007: pa.list_(pa.int64()),         # int4[]
+    1016: pa.list_(pa.int64()),         # int8[]
+    1021: pa.list_(pa.float64()),       # float4[]
+    1022: pa.list_(pa.float64()),       # float8[]
+}
+
+
+class ChunkSink(io.RawIOBase):
+    """A write-only file which keeps the written bytes until they are drained."""
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def arrow_schema(description):
+    """Builds the arrow schema of the columns of a DBAPI cursor description."""
+    return pa.schema([(col[0], ARROW_TYPES.get(col[1], pa.string())) for col in description])
+
+
+def arrow_column(values, arrow_type):
+    """Builds an arrow array of the given type, converting to text and float the values which arrow
+    would not convert (e.g. geometries, Decimal)."""
+    if arrow_type == pa.string():
+        values = [None if value is None else str(value) for value in values]
+    elif arrow_type == pa.float64():
+        values = [None if value is None else float(value) for value in values]
+    return pa.array(values, type=arrow_type)
+
+
+def stream_parquet(result, batch_size=10000):
+    """Writes the rows of a query result as a Parquet file, one row group per batch of rows.
+    The file is yielded in chunks as the row groups are written, so that only one batch of rows
+    is in memory. The result should be executed with stream_results, i.e. on a server-side cursor.
+
+    Parameters
+    ----------
+    result: the result of the query
+    batch_size: rows per row group (default is 10000)
+    """
+    sink = ChunkSink()
+    writer = None
+    # the first row of a server-side cursor is prefetched by the execution, so the description is 
+    # available now, while the cursor is released as soon as the last row is fetched
+    description = None if result.cursor is None else result.cursor.description
+    schema = None if description is None else arrow_schema(description)
+    for rows in result.partitions(batch_size):
+        if writer is None:
+            writer = pq.ParquetWriter(sink, schema)
+        columns = list(zip(*rows))
+        writer.write_table(pa.Table.from_arrays(
+            [arrow_column(values, field.type) for values, field in zip(columns, schema)], schema=schema))
+        yield sink.drain()
+    if writer is None:
+        # no rows, write an empty file with text columns
+        writer = pq.ParquetWriter(sink, pa.schema([(key, pa.string()) for key in result.keys()]))
+    writer.close()
+    yield sink.drain()
+
+
+def json_default(value):
+    """Serializes the values which json does not handle: timestamps as ISO 8601, numerics as float."""
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return str(value)
+
+
+def stream_csv(result, batch_size=10000):
+    """Writes the rows of a query result as CSV, yielding one chunk per batch of rows.
+    Arrays are written as bracketed lists (e.g. '[0.1, 0.2]'), as the loaders accept them.
+
+    Parameters
+    ----------
+    result: the result of the query, executed with stream_results
+    batch_size: rows per chunk (default is 10000)
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(result.keys())
+    for rows in result.partitions(batch_size):
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def stream_ndjson(result, batch_size=10000):
+    """Writes the rows of a query result as NDJSON, one object per line, yielding one chunk per batch of rows.
+
+    Parameters
+    ----------
+    result: the result of the query, executed with stream_results
+    batch_size: rows per chunk (default is 10000)
+    """
+    keys = list(result.keys())
+    for rows in result.partitions(batch_size):
+        yield ''.join(json.dumps(dict(zip(keys, row)), default=json_default) + '\n' for row in rows)
+
+
+def stream_geojson(result, batch_size=10000, geometry='geometry'):
+    """Writes the rows of a query result as a GeoJSON FeatureCollection, yielding one chunk per batch of rows.
+
+    Parameters
+    ----------
+    result: the result of the query, executed with stream_results, with a column already encoded as GeoJSON
+    batch_size: rows per chunk (default is 10000)
+    geometry: the name of the GeoJSON geometry column (default is 'geometry')
+    """
+    keys = list(result.keys())
+    geom_index = keys.index(geometry)
+    yield '{"type": "FeatureCollection", "features": ['
+    first = True
+    for rows in result.partitions(batch_size):
+        features = []
+        for row in rows:
+            properties = {key: value for i, (key, value) in enumerate(zip(keys, row)) if i != geom_index}
+            features.append('{"type": "Feature", "geometry": %s, "properties": %s}' % (
+                row[geom_index] or 'null', json.dumps(properties, default=json_default)))
+        if features:
+            yield ('' if first else ',') + ','.join(features)
+            first = False
+    yield ']}'
+
+
+def stream_json_rows(result, batch_size=10000, exclude=()):
+    """Writes the rows of a query result as {"data": [...]}, one object per row, as the acquisitions 
+    tables load them, yielding one chunk per batch of rows. Values are serialized as Flask does,
+    so an application context is required.
+
+    Parameters
+    ----------
+    result: the result of the query, executed with stream_results
+    batch_size: rows per chunk (default is 10000)
+    exclude: the columns not to write
+    """
+    keys = [key for key in result.keys() if key not in exclude]
+    indexes = [i for i, key in enumerate(result.keys()) if key not in exclude]
+    yield '{"data": ['
+    first = True
+    for rows in result.partitions(batch_size):
+        if rows:
+            yield ('' if first else ',') + ','.join(
+                flask_json.dumps({key: row[i] for key, i in zip(keys, indexes)}) for row in rows)
+            first = False
+    yield ']}'
+
+
+# format -> (writer, mimetype, file extension)
+EXPORT_FORMATS = {
+    'parquet': (stream_parquet, 'application/vnd.apache.parquet', 'parquet'),
+    'csv': (stream_csv, 'text/csv', 'csv'),
+    'ndjson': (stream_ndjson, 'application/x-ndjson', 'ndjson'),
+    'geojson': (stream_geojson, 'application/geo+json', 'geojson'),
+}
@@ -0,0 +1,177 @@
+import os
+import time
+import uuid
+import shutil
+import tempfile
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.utils import secure_filename
+
+from pignoletto import app, db, db_manager
+
+
+class Job(object):
+    """A background job, with its status ('queued', 'running', 'done' or 'failed'), the last report
+    of its progress and its result. Each job has its own temporary directory, removed when it ends.
+    """
+    def __init__(self, kind):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = 'queued'
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.work_dir = tempfile.mkdtemp(prefix=f'{kind}_{self.id}_')
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": self.progress,
+            "result": self.result,
+            "error": self.error,
+            "created": self.created,
+            "finished": self.finished
+        }
+
+
+class JobQueue(object):
+    """Runs jobs on a pool of threads, so that the requests submitting them return at once. The heavy work
+    of the jobs is done by subprocesses (e.g. gdalwarp, raster2pgsql), the threads mostly wait for them.
+    Jobs are kept in the memory of the process, finished ones for ttl seconds.
+    """
+    def __init__(self, max_workers=2, ttl=86400):
+        self.max_workers = max_workers
+        self.ttl = ttl
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pid = None
+
+    def get_executor(self):
+        # the threads of a pool do not survive a fork, e.g. of the uWSGI workers
+        if self.executor is None or self.pid != os.getpid():
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='pignoletto-job')
+            self.pid = os.getpid()
+        return self.executor
+
+    def create(self, kind):
+        """Creates a job, which is run once started. Files the job needs can be written in its work_dir meanwhile."""
+        job = Job(kind)
+        with self.lock:
+            self.prune()
+            self.jobs[job.id] = job
+        return job
+
+    def start(self, job, target, *args, **kwargs):
+        """Runs target(job, *args, **kwargs) in background, within an application context."""
+        self.get_executor().submit(self.run, job, target, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def run(self, job, target, args, kwargs):
+        job.status = 'running'
+        try:
+            with app.app_context():
+                try:
+                    job.result = target(job, *args, **kwargs)
+                finally:
+                    db.session.remove()
+            job.status = 'done'
+        except Exception as e:
+            traceback.print_exc()
+            job.error = str(e)
+            job.status = 'failed'
+        finally:
+            job.finished = time.time()
+            shutil.rmtree(job.work_dir, ignore_errors=True)
+
+    def prune(self):
+        expired = time.time() - self.ttl
+        for job_id in [cur_id for cur_id, cur_job in self.jobs.items()
+                       if cur_job.finished is not None and cur_job.finished < expired]:
+            del self.jobs[job_id]
+
+
+job_queue = JobQueue(max_workers=app.config.get("RASTER_IMPORT_WORKERS", 2), ttl=app.config.get("JOB_TTL", 86400))
+
+
+def import_raster(job, raster_fn, table_name, **kwargs):
+    """Imports a raster (see DBManager.insert_raster) and adds it to the QGIS project."""
+    def progress(report):
+        job.progress = dict(report)
+    report = db_manager.insert_raster(raster_fn, table_name, work_dir=job.work_dir, progress=progress, **kwargs)
+    # synchronize the project with the new raster table
+    from pignoletto import start_create_views
+    start_create_views()
+    return report
+
+
+def import_vectors(job, path, **kwargs):
+    """Imports the layers of a vector file (see DBManager.insert_vectors) and adds them to the QGIS project."""
+    def progress(report):
+        job.progress = dict(report)
+    report = db_manager.insert_vectors(path, work_dir=job.work_dir, progress=progress, **kwargs)
+    # synchronize the project with the new vector tables
+    from pignoletto import start_create_views
+    start_create_views()
+    return report
+
+
+def save_upload(job, file):
+    """Saves an uploaded file in the directory of a job, removing the job if it cannot be saved.
+
+    Returns
+    -------
+    str : the path of the saved file
+    """
+    path = os.path.join(job.work_dir, 'upload_' + (secure_filename(file.filename) or 'file'))
+    try:
+        file.save(path)
+    except Exception:
+        with job_queue.lock:
+            job_queue.jobs.pop(job.id, None)
+        shutil.rmtree(job.work_dir, ignore_errors=True)
+        raise
+    return path
+
+
+def submit_raster_import(file, table_name, **kwargs):
+    """Saves an uploaded raster in a new job directory and queues its import.
+
+    Parameters
+    ----------
+    file: the uploaded file (a werkzeug FileStorage)
+    table_name: name of the raster, the table is raster_<table_name>
+    kwargs: the other arguments of DBManager.insert_raster
+
+    Returns
+    -------
+    Job : the queued job
+    """
+    job = job_queue.create('raster_import')
+    raster_fn = save_upload(job, file)
+    return job_queue.start(job, import_raster, raster_fn, table_name, **kwargs)
+
+
+def submit_vector_import(file, **kwargs):
+    """Saves an uploaded GeoPackage, shapefile or zip of them in a new job directory and queues its import.
+
+    Parameters
+    ----------
+    file: the uploaded file (a werkzeug FileStorage)
+    kwargs: the other arguments of DBManager.insert_vectors
+
+    Returns
+    -------
+    Job : the queued job
+    """
+    job = job_queue.create('vector_import')
+    path = save_upload(job, file)
+    return job_queue.start(job, import_vectors, path, **kwargs)
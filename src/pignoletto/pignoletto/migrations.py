@@ -0,0 +1,191 @@
+import sqlalchemy as sa
+
+
+# table keeping track of the applied migrations
+MIGRATIONS_TABLE = 'schema_migrations'
+# key of the advisory lock serializing the migrations of concurrent workers
+MIGRATIONS_LOCK = 4242001
+
+
+def dependent_views(conn, tables, column):
+    """Gets the views and materialized views which depend on a column of the given tables.
+
+    Returns
+    -------
+    list : (view name, relkind) for each view
+    """
+    return conn.execute(sa.text('''
+        SELECT DISTINCT v.relname, v.relkind
+        FROM pg_depend d
+                JOIN pg_rewrite r ON r.oid = d.objid
+                JOIN pg_class v ON v.oid = r.ev_class
+        WHERE d.classid = 'pg_rewrite'::regclass AND v.oid <> d.refobjid
+              AND d.refobjid IN (SELECT to_regclass(t) FROM unnest(CAST(:tables AS text[])) t)
+              AND d.refobjsubid = (SELECT attnum FROM pg_attribute WHERE attrelid = d.refobjid AND attname = :column)
+    '''), {'tables': list(tables), 'column': column}).all()
+
+
+def core_indexes(conn):
+    """Indexes on the columns joined by the layer views and looked up by the ingestion."""
+    for table, columns, method in [
+        ('drone_acquisition', 'coords', 'GIST'),
+        ('lab_acquisition', 'coords', 'GIST'),
+        ('drone_acquisition', 'site', 'BTREE'),
+        ('lab_acquisition', 'site', 'BTREE'),
+        ('estimation', 'drone_acquisition', 'BTREE'),
+        ('estimation', 'model', 'BTREE'),
+        ('measure', 'id_variable', 'BTREE'),
+        ('estimated_value', 'id_variable', 'BTREE'),
+        ('site', 'name', 'BTREE'),
+    ]:
+        conn.execute(sa.text(f'CREATE INDEX IF NOT EXISTS {table}_{columns}_idx ON {table} USING {method} ({columns})'))
+    # update the planner statistics
+    for table in ('drone_acquisition', 'lab_acquisition', 'estimation', 'measure', 'estimated_value', 'site'):
+        conn.execute(sa.text(f'ANALYZE {table}'))
+
+
+def typed_geometries(conn, srid=3003):
+    """Types the coordinates of the acquisitions as points with their SRID. The views depending
+    on them are dropped, they are created again by the next synchronization of the project.
+    """
+    geom_type = f'geometry(Point,{srid})'
+    to_alter = [table for table in ('drone_acquisition', 'lab_acquisition') if conn.execute(sa.text('''
+        SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+        WHERE attrelid = to_regclass(:table) AND attname = 'coords'
+    '''), {'table': table}).scalar() != geom_type]
+    if not to_alter:
+        return
+    for view, relkind in dependent_views(conn, to_alter, 'coords'):
+        conn.execute(sa.text('DROP {}VIEW IF EXISTS {} CASCADE'.format(
+            'MATERIALIZED ' if relkind == 'm' else '', conn.dialect.identifier_preparer.quote(view))))
+    for table in to_alter:
+        conn.execute(sa.text(f'''
+            ALTER TABLE {table} ALTER COLUMN coords TYPE {geom_type}
+            USING ST_SetSRID(coords, {srid})
+        '''))
+        conn.execute(sa.text(f'ANALYZE {table}'))
+
+
+def unique_site_names(conn):
+    """Merges the sites with the same name, makes the names unique and realigns the id sequence
+    with the ids inserted explicitly.
+    """
+    conn.execute(sa.text('''
+        CREATE TEMP TABLE site_duplicates ON COMMIT DROP AS
+            SELECT id, keep FROM (SELECT id, min(id) OVER (PARTITION BY name) AS keep FROM site) s
+            WHERE id <> keep
+    '''))
+    for table in ('drone_acquisition', 'lab_acquisition', 'estimation'):
+        conn.execute(sa.text(f'''
+            UPDATE {table} SET site = d.keep FROM site_duplicates d WHERE {table}.site = d.id
+        '''))
+    conn.execute(sa.text('DELETE FROM site USING site_duplicates d WHERE site.id = d.id'))
+    conn.execute(sa.text('DROP INDEX IF EXISTS site_name_idx'))
+    exists = conn.execute(sa.text('''
+        SELECT 1 FROM pg_constraint WHERE conrelid = to_regclass('site') AND conname = 'site_name_key'
+    ''')).first()
+    if exists is None:
+        conn.execute(sa.text('ALTER TABLE site ADD CONSTRAINT site_name_key UNIQUE (name)'))
+    conn.execute(sa.text('''
+        SELECT setval(pg_get_serial_sequence('site', 'id'), GREATEST((SELECT max(id) FROM site), 1))
+    '''))
+
+
+def outdb_rasters(conn):
+    """Lets PostGIS read the out-db rasters, i.e. the GeoTIFF files referenced by the raster tables.
+    Changing these settings requires a superuser, without the privilege it is left to the administrator.
+    """
+    conn.execute(sa.text('''
+        DO $$
+        BEGIN
+            EXECUTE format('ALTER DATABASE %I SET postgis.enable_outdb_rasters = true', current_database());
+            EXECUTE format('ALTER DATABASE %I SET postgis.gdal_enabled_drivers = %L', current_database(), 'GTiff');
+        EXCEPTION WHEN insufficient_privilege THEN
+            RAISE WARNING 'Out-db rasters not enabled, superuser required';
+        END
+        $$
+    '''))
+
+
+def vector_master(conn):
+    """Table of the imported vector layers, as raster_master for the rasters."""
+    conn.execute(sa.text('''
+        CREATE TABLE IF NOT EXISTS vector_master (
+            id serial NOT NULL,
+            layer_name varchar(60) NOT NULL,
+            table_name varchar(60) NOT NULL,
+            source varchar(200),
+            geometry_type varchar(30),
+            features bigint,
+            visible boolean DEFAULT true,
+
+            CONSTRAINT vector_master_table_name_key UNIQUE (table_name),
+            PRIMARY KEY (id)
+        )
+    '''))
+
+
+def raster_stats(conn):
+    """Table caching the statistics and the colour ramp classification of each raster, see DBManager.get_raster_stats."""
+    conn.execute(sa.text('''
+        CREATE TABLE IF NOT EXISTS raster_stats (
+            table_name varchar(60) PRIMARY KEY,
+            version varchar(60) NOT NULL,
+            min float NOT NULL,
+            max float NOT NULL,
+            count bigint NOT NULL,
+            histogram bigint[] NOT NULL,
+            num_classes int NOT NULL,
+            breaks float[] NOT NULL,
+            updated timestamp NOT NULL DEFAULT now()
+        )
+    '''))
+
+
+def raster_versions(conn):
+    """Version of each raster, incremented by DBManager.register_raster when the raster is imported again."""
+    conn.execute(sa.text('ALTER TABLE raster_master ADD COLUMN IF NOT EXISTS version int NOT NULL DEFAULT 1'))
+
+
+# ordered list of (id, migration), never change the id of an applied migration
+MIGRATIONS = [
+    ('0001_core_indexes', core_indexes),
+    ('0002_typed_geometries', typed_geometries),
+    ('0003_unique_site_names', unique_site_names),
+    ('0004_outdb_rasters', outdb_rasters),
+    ('0005_vector_master', vector_master),
+    ('0006_raster_stats', raster_stats),
+    ('0007_raster_versions', raster_versions),
+]
+
+
+def migrate(engine):
+    """Applies the missing migrations, each in its own transaction.
+
+    Returns
+    -------
+    list : the ids of the applied migrations
+    """
+    applied = []
+    with engine.connect() as conn:
+        conn.execute(sa.text(f'''
+            CREATE TABLE IF NOT EXISTS {MIGRATIONS_TABLE} (
+                id varchar(60) PRIMARY KEY,
+                applied timestamp NOT NULL DEFAULT now()
+            )
+        '''))
+        for cur_id, cur_migration in MIGRATIONS:
+            with conn.begin():
+                # migrations rewrite whole tables, they are not bound by STATEMENT_TIMEOUT
+                conn.execute(sa.text('SET LOCAL statement_timeout = 0'))
+                # one worker at a time, the others find the migration already applied
+                conn.execute(sa.text('SELECT pg_advisory_xact_lock(:key)'), {'key': MIGRATIONS_LOCK})
+                done = conn.execute(sa.text(f'SELECT 1 FROM {MIGRATIONS_TABLE} WHERE id = :id'), {'id': cur_id}).first()
+                if done is not None:
+                    continue
+                cur_migration(conn)
+                conn.execute(sa.text(f'INSERT INTO {MIGRATIONS_TABLE} (id) VALUES (:id)'), {'id': cur_id})
+                applied.append(cur_id)
+    for cur_id in applied:
+        print(f"Migration {cur_id} applied.")
+    return applied
@@ -1,8 +1,9 @@
-from sqlalchemy import Table, Column, Index
+from sqlalchemy import Table, Column, Index, ForeignKey, Integer, BigInteger, String, DateTime, Boolean, LargeBinary, text
+from sqlalchemy.dialects.postgresql import ARRAY, DOUBLE_PRECISION
 from flask_login import UserMixin
 from geoalchemy2 import Geometry
 
-from pignoletto import meta, db, engine
+from pignoletto import meta, db
 
 
 # Define methods for views
@@ -15,8 +16,9 @@ class CreateView(DDLElement):
         self.materialized = materialized
 @compiler.compiles(CreateView)
 def compile_create_materialized_view(element, compiler, **kw):
-    return 'CREATE OR REPLACE {}VIEW {} AS {}'.format(
-        'MATERIALIZED ' if element.materialized else '',
+    # PostgreSQL cannot replace a materialized view, it is created only if missing
+    return 'CREATE {} {} AS {}'.format(
+        'MATERIALIZED VIEW IF NOT EXISTS' if element.materialized else 'OR REPLACE VIEW',
         compiler.dialect.identifier_preparer.quote(element.name),
         compiler.sql_compiler.process(element.selectable, literal_binds=True),
     )
@@ -41,40 +43,93 @@ class new_Geometry(Geometry):
     from_text = 'ST_GeomFromEWKB'
     as_binary = 'ST_GeomFromEWKB'
     ElementType = WKBElement
-lab_acq = Table('lab_acquisition', meta, 
-            Column('coords', new_Geometry('POINT', srid=4326)),
-            # additional Column objects which require no change are reflected normally
-            autoload_with=engine)
-drone_acq = Table('drone_acquisition', meta, 
-            Column('coords', new_Geometry('POINT', srid=4326)),
-            autoload_with=engine)
-estimated_value = Table("estimated_value", meta, autoload=True, autoload_with=engine)
-estimation = Table("estimation", meta, autoload=True, autoload_with=engine)
-measure = Table("measure", meta, autoload=True, autoload_with=engine)
-model = Table("model", meta, autoload=True, autoload_with=engine)
-#raster_c_flow = Table("raster_c_flow", meta, autoload=True, autoload_with=engine)
-#raster_c_gen = Table("raster_c_gen", meta, autoload=True, autoload_with=engine)
-#raster_c_long = Table("raster_c_long", meta, autoload=True, autoload_with=engine)
-#raster_c_max = Table("raster_c_max", meta, autoload=True, autoload_with=engine)
-#raster_c_min = Table("raster_c_min", meta, autoload=True, autoload_with=engine)
-#raster_c_plane = Table("raster_c_plane", meta, autoload=True, autoload_with=engine)
-#raster_c_prof = Table("raster_c_prof", meta, autoload=True, autoload_with=engine)
-#raster_c_tang = Table("raster_c_tang", meta, autoload=True, autoload_with=engine)
-#raster_c_tot = Table("raster_c_tot", meta, autoload=True, autoload_with=engine)
-#raster_c_tran = Table("raster_c_tran", meta, autoload=True, autoload_with=engine)
-#raster_exposition = Table("raster_exposition", meta, autoload=True, autoload_with=engine)
-raster_master = Table("raster_master", meta, autoload=True, autoload_with=engine)
-#raster_ridge = Table("raster_ridge", meta, autoload=True, autoload_with=engine)
-#raster_slope = Table("raster_slope", meta, autoload=True, autoload_with=engine)
-#raster_valley = Table("raster_valley", meta, autoload=True, autoload_with=engine)
-#shape_landuse = Table("shape_landuse", meta, autoload=True, autoload_with=engine)
-site = Table("site", meta, autoload=True, autoload_with=engine)
-spatial_ref_sys = Table("spatial_ref_sys", meta, autoload=True, autoload_with=engine)
-variable = Table("variable", meta, autoload=True, autoload_with=engine)
+
+
+# Tables are declared as in database/insert.sql instead of being reflected, so that no catalog
+# query runs at import time. Raster and vector tables are listed in raster_master
+# and vector_master and queried by name.
+site = Table("site", meta,
+            Column("id", Integer, primary_key=True),
+            Column("name", String(60), nullable=False, unique=True),
+            Column("description", String(100)))
+drone_acq = Table("drone_acquisition", meta,
+            Column("id", Integer, primary_key=True),
+            Column("lat", DOUBLE_PRECISION, nullable=False),
+            Column("lon", DOUBLE_PRECISION, nullable=False),
+            Column("time", DateTime, nullable=False),
+            Column("site", Integer, ForeignKey("site.id", onupdate="CASCADE", ondelete="RESTRICT")),
+            Column("coords", new_Geometry("POINT", srid=3003)),
+            Column("gamma", ARRAY(DOUBLE_PRECISION)),
+            Column("start_acq_time", DateTime, nullable=False),
+            Column("stop_acq_time", DateTime, nullable=False),
+            Column("mission", String(30)),
+            Column("path", String(30)),
+            Column("acquisition", String(30)),
+            Column("z", Integer),
+            Column("start_band", Integer, nullable=False),
+            Column("stop_band", Integer, nullable=False))
+images = Table("images", meta,
+            Column("id", Integer, primary_key=True),
+            Column("file", LargeBinary, nullable=False),
+            Column("name", String(30), nullable=False))
+variable = Table("variable", meta,
+            Column("id", Integer, primary_key=True),
+            Column("name", String(50), nullable=False),
+            Column("unit_of_measure", String(50), nullable=False),
+            Column("description", String(2000)))
 # use Index in order to apply the unique function for queries poiting this table
 variable_unique = Index('variable_unique', variable.c.id, variable.c.name, unique=True)
-
-images = Table("images", meta, autoload=True, autoload_with=engine)
+model = Table("model", meta,
+            Column("id", Integer, primary_key=True),
+            Column("name", String(60), nullable=False),
+            Column("path", String(200), nullable=False),
+            Column("file", LargeBinary, nullable=False))
+estimation = Table("estimation", meta,
+            Column("id", Integer, primary_key=True),
+            Column("time", DateTime, nullable=False),
+            Column("drone_acquisition", Integer,
+                   ForeignKey("drone_acquisition.id", onupdate="CASCADE", ondelete="RESTRICT"), nullable=False),
+            Column("model", Integer, ForeignKey("model.id", onupdate="CASCADE", ondelete="RESTRICT"), nullable=False),
+            Column("site", Integer, ForeignKey("site.id", onupdate="CASCADE", ondelete="RESTRICT")))
+estimated_value = Table("estimated_value", meta,
+            Column("id_estimation", Integer, ForeignKey("estimation.id", onupdate="CASCADE", ondelete="RESTRICT"),
+                   primary_key=True),
+            Column("id_variable", Integer, ForeignKey("variable.id", onupdate="CASCADE", ondelete="RESTRICT"),
+                   primary_key=True),
+            Column("value", DOUBLE_PRECISION, nullable=False))
+lab_acq = Table("lab_acquisition", meta,
+            Column("id", String(20), primary_key=True),
+            Column("lat", DOUBLE_PRECISION, nullable=False),
+            Column("lon", DOUBLE_PRECISION, nullable=False),
+            Column("time", DateTime, nullable=False),
+            Column("nlab", String(50), nullable=False),
+            Column("nfield", String(50), nullable=False),
+            Column("depth", String(50), nullable=False),
+            Column("site", Integer, ForeignKey("site.id", onupdate="CASCADE", ondelete="RESTRICT")),
+            Column("coords", new_Geometry("POINT", srid=3003)),
+            Column("hyperspectral", ARRAY(DOUBLE_PRECISION), nullable=False),
+            Column("gamma", ARRAY(DOUBLE_PRECISION)))
+measure = Table("measure", meta,
+            Column("id_lab_acquisition", String(20),
+                   ForeignKey("lab_acquisition.id", onupdate="CASCADE", ondelete="RESTRICT"), primary_key=True),
+            Column("id_variable", Integer, ForeignKey("variable.id", onupdate="CASCADE", ondelete="RESTRICT"),
+                   primary_key=True),
+            Column("value", DOUBLE_PRECISION, nullable=False))
+raster_master = Table("raster_master", meta,
+            Column("id", Integer, primary_key=True),
+            Column("layer_name", String(60), nullable=False),
+            Column("table_name", String(60), nullable=False),
+            Column("description", String(100)),
+            Column("visible", Boolean, server_default=text("true")),
+            Column("version", Integer, nullable=False, server_default=text("1")))
+vector_master = Table("vector_master", meta,
+            Column("id", Integer, primary_key=True),
+            Column("layer_name", String(60), nullable=False),
+            Column("table_name", String(60), nullable=False, unique=True),
+            Column("source", String(200)),
+            Column("geometry_type", String(30)),
+            Column("features", BigInteger),
+            Column("visible", Boolean, server_default=text("true")))
 
 
 User_Role_model = db.Table("user_role",
@@ -0,0 +1,180 @@
+import io
+import base64
+import binascii
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+def to_pg_arrays(values):
+    """Formats each row of a 2D numeric array as a PostgreSQL array literal (e.g. '{0.1,0.2}')."""
+    buffer = io.StringIO()
+    np.savetxt(buffer, values, fmt='%.17g', delimiter=',')
+    return ['{' + row + '}' for row in buffer.getvalue().splitlines()]
+
+
+# a bracketed, comma separated list of floats, e.g. '[0.1, 2e-3]'; each number matches in a single way,
+# so that a non-valid list is rejected in linear time
+FLOAT_PATTERN = r'\s*[-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?\s*'
+FLOAT_LIST_PATTERN = rf'\[{FLOAT_PATTERN}(?:,{FLOAT_PATTERN})*\]|{FLOAT_PATTERN}(?:,{FLOAT_PATTERN})*'
+
+
+def parse_pg_arrays(series):
+    """Validates a Series of float lists written as text (e.g. '[0.1, 0.2]') and converts them
+    to PostgreSQL array literals (e.g. '{0.1,0.2}') without evaluating them. Values which are 
+    already lists or arrays (e.g. from JSON or a Parquet list column) are formatted directly.
+
+    Returns
+    -------
+    tuple: the Series of literals (NaN where not valid) and the boolean mask of valid entries
+    """
+    is_list = series.map(lambda value: isinstance(value, (list, tuple, np.ndarray))).to_numpy(dtype=bool)
+    if is_list.all():
+        return list_pg_arrays(series)
+    text = series[~is_list].astype(str).str.strip()
+    valid_text = text.str.fullmatch(FLOAT_LIST_PATTERN).fillna(False).astype(bool)
+    literals = pd.Series(np.nan, index=series.index, dtype=object)
+    valid = np.zeros(len(series), dtype=bool)
+    literals.iloc[np.flatnonzero(~is_list)] = \
+        ('{' + text.str.strip('[]').str.replace(r'\s+', '', regex=True) + '}').where(valid_text).to_numpy()
+    valid[~is_list] = valid_text.to_numpy()
+    if is_list.any():
+        list_literals, list_valid = list_pg_arrays(series[is_list])
+        literals.iloc[np.flatnonzero(is_list)] = list_literals.to_numpy()
+        valid[is_list] = list_valid
+    return literals, valid
+
+
+def parse_float_list(text):
+    """Parses a float list written as text (e.g. '[0.1, 0.2]') with the rules of parse_pg_arrays.
+
+    Returns
+    -------
+    numpy.ndarray: the values, None if the text is not valid
+    """
+    literals, valid = parse_pg_arrays(pd.Series([text], dtype=object))
+    return np.array(literals[0][1:-1].split(','), dtype=float) if valid[0] else None
+
+
+def arrays_to_pg(arrays, index):
+    """Formats a list of float arrays (None where not valid) as PostgreSQL array literals, formatting 
+    the arrays of the same length together. Empty arrays and arrays with non-finite values are not valid.
+
+    Returns
+    -------
+    tuple: the Series of literals (NaN where not valid) and the boolean mask of valid entries
+    """
+    lengths = np.array([-1 if values is None else len(values) for values in arrays], dtype=int)
+    literals = pd.Series(np.nan, index=index, dtype=object)
+    for length in np.unique(lengths[lengths > 0]):
+        rows = np.flatnonzero(lengths == length)
+        values = np.stack([arrays[i] for i in rows]).astype(float)
+        finite = np.isfinite(values).all(axis=1)
+        literals.iloc[rows[finite]] = to_pg_arrays(values[finite])
+        lengths[rows[~finite]] = -1
+    return literals, lengths > 0
+
+
+def list_pg_arrays(series):
+    """Converts a Series of float lists or arrays to PostgreSQL array literals (see arrays_to_pg)."""
+    arrays = []
+    for value in series:
+        try:
+            arrays.append(np.asarray(value, dtype=float).ravel() if isinstance(value, (list, tuple, np.ndarray)) else None)
+        except (TypeError, ValueError):
+            arrays.append(None)
+    return arrays_to_pg(arrays, series.index)
+
+
+# binary encodings of the float arrays: base64 of little-endian float32 or float64 values
+ARRAY_ENCODINGS = {'f4': '<f4', 'f8': '<f8'}
+
+
+def decode_array(value, encoding):
+    """Decodes a base64 string of little-endian floats (encoding 'f4' or 'f8') into a numpy array.
+
+    Returns
+    -------
+    numpy.ndarray: the values, None if the string is not valid or empty or contains non-finite values
+    """
+    if encoding not in ARRAY_ENCODINGS:
+        raise ValueError(f'Array encoding {encoding} not supported.')
+    dtype = np.dtype(ARRAY_ENCODINGS[encoding])
+    try:
+        raw = base64.b64decode(value, validate=True)
+    except (TypeError, ValueError, binascii.Error):
+        return None
+    if not raw or len(raw) % dtype.itemsize:
+        return None
+    values = np.frombuffer(raw, dtype=dtype)
+    return values if np.isfinite(values).all() else None
+
+
+def decode_pg_arrays(series, encoding):
+    """Decodes a Series of base64 encoded float arrays (see decode_array) and converts them to
+    PostgreSQL array literals (see arrays_to_pg).
+
+    Returns
+    -------
+    tuple: the Series of literals (NaN where not valid) and the boolean mask of valid entries
+    """
+    return arrays_to_pg([decode_array(value, encoding) for value in series], series.index)
+
+
+def read_csv_chunks(csv, sep=',', chunk_size=None):
+    """Reads a CSV file lazily, yielding DataFrames of at most chunk_size rows.
+
+    Parameters
+    ----------
+    csv: a path or a file-like object
+    sep: the CSV delimiter (default is ',')
+    chunk_size: rows per chunk, if None the whole file is yielded at once
+    """
+    if chunk_size is None:
+        yield pd.read_csv(csv, sep=sep)
+        return
+    with pd.read_csv(csv, sep=sep, chunksize=chunk_size) as reader:
+        for chunk in reader:
+            yield chunk
+
+
+# columnar formats accepted by the loaders besides CSV, Arrow files are in the IPC (feather v2) format
+COLUMNAR_FORMATS = ('parquet', 'arrow', 'feather')
+
+
+def read_columnar_chunks(source, file_format='parquet', chunk_size=None):
+    """Reads a Parquet or Arrow file lazily, yielding DataFrames of at most chunk_size rows.
+    List columns (e.g. gamma, hyperspectral) are yielded as numpy arrays.
+
+    Parameters
+    ----------
+    source: a path or a seekable file-like object
+    file_format: 'parquet', 'arrow' or 'feather'
+    chunk_size: rows per chunk, if None the whole file is yielded at once
+    """
+    if file_format == 'parquet':
+        parquet_file = pq.ParquetFile(source)
+        if chunk_size is None:
+            yield parquet_file.read().to_pandas()
+            return
+        for batch in parquet_file.iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    elif file_format in ('arrow', 'feather'):
+        reader = pa.ipc.open_file(source)
+        if chunk_size is None:
+            yield reader.read_all().to_pandas()
+            return
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            for offset in range(0, batch.num_rows, chunk_size):
+                yield batch.slice(offset, chunk_size).to_pandas()
+    else:
+        raise ValueError(f'File format {file_format} not supported.')
+
+
+def read_chunks(source, file_format='csv', sep=',', chunk_size=None):
+    """Reads a CSV, Parquet or Arrow file lazily, yielding DataFrames of at most chunk_size rows."""
+    if file_format == 'csv':
+        return read_csv_chunks(source, sep=sep, chunk_size=chunk_size)
+    return read_columnar_chunks(source, file_format=file_format, chunk_size=chunk_size)
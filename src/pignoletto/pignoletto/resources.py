@@ -1,19 +1,29 @@
 from datetime import datetime
-from flask_restful import Resource, reqparse, abort
-from flask import request, jsonify, current_app
+from flask_restful import Resource, reqparse, abort, inputs
+from flask import request, jsonify, current_app, Response, stream_with_context
 from functools import wraps
 import jwt
+import json
+import os
+import re
+import shutil
+import tempfile
+import pandas as pd
 from pignoletto import db, db_manager
+from .DBManager import TABLE_NAME_PATTERN
+from .readers import ARRAY_ENCODINGS, decode_array, parse_float_list
+from .exporters import EXPORT_FORMATS
+from .auth import get_principal
+from .jobs import job_queue, submit_raster_import, submit_vector_import
 from .models import (
-    User_model,
-    drone_acq,
-    site
+    drone_acq
 )
 from geoalchemy2 import func
-import numpy as np
 
 
-ALLOWED_EXTENSIONS = set(["csv"])
+ALLOWED_EXTENSIONS = set(["csv", "parquet", "arrow", "feather"])
+RASTER_EXTENSIONS = set(["tif", "tiff"])
+VECTOR_EXTENSIONS = set(["gpkg", "zip"])
 def allowed_file(filename):
     """Checks that a given file name has a valid extension.
 
@@ -41,9 +51,15 @@ def token_required(f):
             abort(401, message="Token missing")
         try:
             data = jwt.decode(token, current_app.config["SECRET_KEY"], algorithms="HS256")
-            current_user = db.session.query(User_model).filter_by(id=data["id"]).first()
         except Exception as e:
             abort(401, message="Token invalid")
+        # cached principal, the database is queried only when it is missing or expired
+        current_user = get_principal(data.get("id"))
+        if current_user is None or not current_user.verified:
+            abort(401, message="Token invalid")
+        # the role signed in the token must still be granted
+        if "role" in data and not current_user.has_role(data["role"]):
+            abort(401, message="Token invalid")
         return f(current_user, *args, **kwargs)
     return decorated
 
@@ -62,6 +78,8 @@ class DroneAcquisition(Resource):
     drone_parser.add_argument("bandaIniziale", type=int, help="Starting band required", required=True)
     drone_parser.add_argument("bandaFinale", type=int, help="Ending band required", required=True)
     drone_parser.add_argument("gamma", type=str, help="Measurement's gamma required", required=True)
+    drone_parser.add_argument("gamma_encoding", type=str, choices=("text",) + tuple(ARRAY_ENCODINGS), default="text",
+                              help="Gamma encoding: text or base64 of little-endian float32 (f4) or float64 (f8)")
 
     @token_required
     def post(self, current_user):
@@ -76,21 +94,19 @@ class DroneAcquisition(Resource):
         if args["bandaFinale"] < args["bandaIniziale"]:
             abort(400, message="Bands not consistent.")
         
-        try:
-            gamma = args["gamma"].replace('[', '').replace(']', '')
-            gamma = np.fromstring(gamma, sep=',')
-            if not len(gamma)>0:
+        if args["gamma_encoding"] != "text":
+            gamma = decode_array(args["gamma"], args["gamma_encoding"])
+            if gamma is None:
+                abort(400, message="Gamma values not in a valid format.")
+            gamma = gamma.astype(float)
+        else:
+            # the same rules of the batch and file uploads (see parse_pg_arrays)
+            gamma = parse_float_list(args["gamma"])
+            if gamma is None:
                 abort(400, message="Gamma values not in a valid format.")
-        except Exception as e:
-            abort(400, message=f"{e}")
 
-        res = db.session.query(site).filter(site.c.name == args["site"]).first()
-        if res is None:
-            s = site.insert().values(name=args["site"])
-            db.session.execute(s)
-        # get site ids
-        site_mapping = dict(db.session.query(site.c.name, site.c.id).all())
-        site_id = site_mapping[args["site"]]
+        # get site id, inserting the site if new
+        site_id = None if args["site"] is None else db_manager.get_site_ids([args["site"]])[args["site"]]
 
         add = drone_acq.insert().values(
             start_acq_time = start_acq,
@@ -110,6 +126,7 @@ class DroneAcquisition(Resource):
         )
         db.session.execute(add)
         db.session.commit()
+        db_manager.drone_acquisitions_exist = True
         return jsonify({'message' : "Drone acquisition uploaded successfully"}, 201)
 
 
@@ -121,7 +138,208 @@ class DroneAcquisitions(Resource):
         file = request.files["file"]
         if file and file.filename == '':
             abort(400, message="File not valid.")
-        if file and allowed_file(file.filename):
-            # Call to the DBManager
-            db_manager.insert_drone_acquisition(file)
-        return jsonify({'message' : "Drone acquisitions uploaded successfully"}, 201)
\ No newline at end of file
+        if not file or not allowed_file(file.filename):
+            abort(400, message="File not valid.")
+        gamma_encoding = request.form.get("gamma_encoding", "text")
+        if gamma_encoding != "text" and gamma_encoding not in ARRAY_ENCODINGS:
+            abort(400, message=f"Gamma encoding {gamma_encoding} not supported.")
+        # Call to the DBManager
+        report = db_manager.insert_drone_acquisition(file, chunk_size=current_app.config.get("INGEST_CHUNK_SIZE"),
+                                                     gamma_encoding=gamma_encoding, 
+                                                     file_format=file.filename.rsplit('.', 1)[1])
+        return jsonify({'message' : "Drone acquisitions uploaded successfully",
+                        'rows_read': report['rows_read'],
+                        'inserted': report['inserted'],
+                        'rejected_count': report['rejected_count'],
+                        'rejected': report['rejected']}, 201)
+
+
+class DroneAcquisitionsBatch(Resource):
+    @token_required
+    def post(self, current_user):
+        """Inserts a batch of drone acquisitions, sent as a JSON array or as NDJSON (one acquisition
+        per line), with the same fields and rules of DroneAcquisition. The valid acquisitions are
+        inserted in a single transaction and the status of each item is returned. The gamma_encoding
+        query argument applies to the whole batch.
+        """
+        gamma_encoding = request.args.get("gamma_encoding", "text")
+        if gamma_encoding != "text" and gamma_encoding not in ARRAY_ENCODINGS:
+            abort(400, message=f"Gamma encoding {gamma_encoding} not supported.")
+        # parse the body, a non-valid line or element is rejected on its own
+        items = []
+        if request.mimetype in ("application/x-ndjson", "application/jsonl"):
+            for line in request.get_data(as_text=True).splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    items.append(json.loads(line))
+                except ValueError:
+                    items.append(None)
+        else:
+            items = request.get_json(silent=True)
+            if not isinstance(items, list):
+                abort(400, message="A JSON array of acquisitions is required.")
+        if not items:
+            abort(400, message="No acquisitions found.")
+        max_items = current_app.config.get("API_BATCH_MAX_ITEMS")
+        if max_items is not None and len(items) > max_items:
+            abort(413, message=f"Too many acquisitions, the maximum is {max_items}.")
+
+        # check and convert the fields of each item as drone_parser does
+        reasons = {}
+        records = []
+        for i, item in enumerate(items):
+            records.append({})
+            if not isinstance(item, dict):
+                reasons[i] = "Item not valid."
+                continue
+            for arg in DroneAcquisition.drone_parser.args:
+                value = item.get(arg.name)
+                if value is None:
+                    if arg.required:
+                        reasons[i] = arg.help
+                        break
+                    records[i][arg.name] = arg.default
+                    continue
+                try:
+                    value = arg.type(value)
+                except (TypeError, ValueError) as e:
+                    reasons[i] = f"{arg.name}: {arg.help or e}"
+                    break
+                if arg.choices and value not in arg.choices:
+                    reasons[i] = f"{arg.name}: {value} is not a valid choice"
+                    break
+                records[i][arg.name] = value
+            if i in reasons:
+                records[i] = {}
+        columns = [arg.name for arg in DroneAcquisition.drone_parser.args]
+        df = pd.DataFrame.from_records(records, columns=columns)
+        # Call to the DBManager
+        report = db_manager.insert_drone_frame(df, time_format='%Y-%m-%d %H:%M:%S', gamma_encoding=gamma_encoding)
+        for cur_rejected in report['rejected']:
+            reasons.setdefault(cur_rejected['row'], cur_rejected['reason'])
+        status = [{'index': i, 'status': 'rejected', 'reason': reasons[i]} if i in reasons 
+                  else {'index': i, 'status': 'inserted'} for i in range(len(items))]
+        return jsonify({'message' : "Drone acquisitions uploaded successfully",
+                        'rows_read': len(items),
+                        'inserted': report['inserted'],
+                        'rejected_count': len(reasons),
+                        'items': status}, 201)
+
+
+class AcquisitionsExport(Resource):
+    @token_required
+    def get(self, current_user, dataset):
+        """Streams all the lab ('lab') or drone ('drone') acquisitions as Parquet, CSV, NDJSON or GeoJSON
+        (format argument, default is parquet). Rows are fetched from a server-side cursor and written
+        in batches, so that memory does not grow with the size of the table.
+        """
+        if dataset not in ("lab", "drone"):
+            abort(404, message=f"Dataset {dataset} not found.")
+        file_format = request.args.get("format", "parquet")
+        if file_format not in EXPORT_FORMATS:
+            abort(400, message=f"Format {file_format} not supported.")
+        writer, mimetype, extension = EXPORT_FORMATS[file_format]
+        query = db_manager.get_export_query(dataset, geometry=file_format == "geojson")
+        result = db_manager.stream_query(query)
+        return Response(stream_with_context(writer(result, current_app.config.get("EXPORT_BATCH_SIZE", 10000))),
+                        mimetype=mimetype,
+                        headers={"Content-Disposition": f"attachment; filename={dataset}_acquisitions.{extension}"})
+
+
+class RasterImports(Resource):
+    raster_parser = reqparse.RequestParser()
+    raster_parser.add_argument("table_name", type=str, location="form", help="Raster name required", required=True)
+    raster_parser.add_argument("layer_name", type=str, location="form")
+    raster_parser.add_argument("description", type=str, location="form")
+    raster_parser.add_argument("target_epsg", type=int, location="form", default=4326)
+    raster_parser.add_argument("nodata", type=float, location="form", default=0)
+    raster_parser.add_argument("out_db", type=inputs.boolean, location="form", default=False,
+                               help="Keep the pixels out of the database, in a Cloud-Optimized GeoTIFF")
+
+    @token_required
+    def post(self, current_user):
+        """Queues the import of a GeoTIFF raster and returns the job at once. The raster is reprojected,
+        loaded with its overviews and registered in background, the job status is at /rasters/jobs/<job id>.
+        With out_db, the pixels are stored as a Cloud-Optimized GeoTIFF in RASTER_OUTDB_DIR.
+        """
+        if not current_user.has_role("admin"):
+            abort(403, message="Sorry, you don't have the rights to access")
+        if 'file' not in request.files:
+            abort(404, message="File not found.")
+        file = request.files["file"]
+        if not file or '.' not in file.filename or file.filename.rsplit('.', 1)[1].lower() not in RASTER_EXTENSIONS:
+            abort(400, message="File not valid.")
+        args = RasterImports.raster_parser.parse_args()
+        if not re.fullmatch(TABLE_NAME_PATTERN, args["table_name"]):
+            abort(400, message="Raster name not valid, use lowercase letters, digits and underscores.")
+        out_db_dir = current_app.config.get("RASTER_OUTDB_DIR") if args["out_db"] else None
+        if args["out_db"] and not out_db_dir:
+            abort(400, message="Out-db rasters not configured.")
+        job = submit_raster_import(file, args["table_name"], target_epsg=args["target_epsg"], nodata_val=args["nodata"],
+                                   layer_name=args["layer_name"], description=args["description"], 
+                                   out_db_dir=out_db_dir)
+        return jsonify({'message' : "Raster import queued", 'job': job.as_dict()}, 202)
+
+
+class VectorImports(Resource):
+    vector_parser = reqparse.RequestParser()
+    vector_parser.add_argument("layers", type=str, location="form", 
+                               help="Comma separated names of the layers to import, all if missing")
+    vector_parser.add_argument("target_epsg", type=int, location="form", default=3003)
+
+    @token_required
+    def post(self, current_user):
+        """Queues the import of the layers of a GeoPackage, or of a zip of GeoPackages and shapefiles, and 
+        returns the job at once. The layers are loaded concurrently in background and registered in 
+        vector_master, the job status is at /vectors/jobs/<job id>.
+        """
+        if not current_user.has_role("admin"):
+            abort(403, message="Sorry, you don't have the rights to access")
+        file = get_vector_file()
+        args = VectorImports.vector_parser.parse_args()
+        layers = None
+        if args["layers"]:
+            layers = [cur_layer.strip() for cur_layer in args["layers"].split(",") if cur_layer.strip()]
+        job = submit_vector_import(file, layers=layers, target_epsg=args["target_epsg"],
+                                   max_workers=current_app.config.get("VECTOR_IMPORT_WORKERS", 4),
+                                   group_size=current_app.config.get("VECTOR_IMPORT_GROUP_SIZE", 100000))
+        return jsonify({'message' : "Vector import queued", 'job': job.as_dict()}, 202)
+
+
+class VectorLayers(Resource):
+    @token_required
+    def post(self, current_user):
+        """Lists the layers of a GeoPackage, or of a zip of GeoPackages and shapefiles, to choose the ones to import."""
+        if not current_user.has_role("admin"):
+            abort(403, message="Sorry, you don't have the rights to access")
+        file = get_vector_file()
+        work_dir = tempfile.mkdtemp(prefix='vector_layers_')
+        try:
+            path = os.path.join(work_dir, 'upload.' + file.filename.rsplit('.', 1)[1].lower())
+            file.save(path)
+            layers = db_manager.inspect_vectors(path, work_dir)
+        except ValueError as e:
+            abort(400, message=f"{e}")
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        return jsonify({'layers': layers})
+
+
+def get_vector_file():
+    if 'file' not in request.files:
+        abort(404, message="File not found.")
+    file = request.files["file"]
+    if not file or '.' not in file.filename or file.filename.rsplit('.', 1)[1].lower() not in VECTOR_EXTENSIONS:
+        abort(400, message="File not valid.")
+    return file
+
+
+class ImportJob(Resource):
+    @token_required
+    def get(self, current_user, job_id):
+        """Gets the status, the progress and the result of a raster or vector import."""
+        job = job_queue.get(job_id)
+        if job is None:
+            abort(404, message=f"Job {job_id} not found.")
+        return jsonify(job.as_dict())
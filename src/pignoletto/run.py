@@ -1,4 +1,7 @@
-from pignoletto import app
+from pignoletto import app, start
+
+
+start()
 
 
 if __name__ == '__main__':    
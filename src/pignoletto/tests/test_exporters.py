@@ -0,0 +1,101 @@
+import io
+import os
+import importlib.util
+from datetime import datetime
+from decimal import Decimal
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import sqlalchemy as sa
+from sqlalchemy.dialects.sqlite.base import SQLiteExecutionContext
+
+
+# the module is loaded on its own, importing the pignoletto package connects to the database
+spec = importlib.util.spec_from_file_location(
+    "exporters", os.path.join(os.path.dirname(__file__), "..", "pignoletto", "exporters.py"))
+exporters = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(exporters)
+
+
+class ServerSideExecutionContext(SQLiteExecutionContext):
+    # stream_results on SQLite, so that rows are fetched as from a PostgreSQL server-side cursor
+    def create_server_side_cursor(self):
+        return self._dbapi_connection.cursor()
+
+
+def streamed_engine(rows):
+    engine = sa.create_engine("sqlite://")
+    engine.dialect.supports_server_side_cursors = True
+    engine.dialect.execution_ctx_cls = ServerSideExecutionContext
+    with engine.begin() as conn:
+        conn.execute(sa.text("CREATE TABLE acq (id INTEGER, site TEXT, value REAL)"))
+        for row in rows:
+            conn.execute(sa.text("INSERT INTO acq VALUES (:id, :site, :value)"), row)
+    return engine
+
+
+def export_parquet(rows, batch_size=2):
+    engine = streamed_engine(rows)
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(sa.text("SELECT * FROM acq ORDER BY id"))
+        data = b"".join(exporters.stream_parquet(result, batch_size=batch_size))
+    return pq.read_table(io.BytesIO(data))
+
+
+def as_text(rows):
+    # SQLite gives no type codes, all the columns are exported as text
+    return [{key: str(value) for key, value in row.items()} for row in rows]
+
+
+def test_stream_parquet_one_row():
+    table = export_parquet([{"id": 1, "site": "a", "value": 0.5}])
+    assert table.column_names == ["id", "site", "value"]
+    assert table.to_pylist() == as_text([{"id": 1, "site": "a", "value": 0.5}])
+
+
+def test_stream_parquet_batches():
+    rows = [{"id": i, "site": "s%d" % i, "value": i / 2} for i in range(5)]
+    assert export_parquet(rows).to_pylist() == as_text(rows)
+
+
+def test_stream_parquet_no_rows():
+    table = export_parquet([])
+    assert table.num_rows == 0
+    assert table.column_names == ["id", "site", "value"]
+
+
+class PostgresResult(object):
+    # a streamed result of a PostgreSQL query, with the type oids of its columns in the cursor description
+    def __init__(self, description, rows):
+        self.cursor = type("Cursor", (), {"description": description})()
+        self.rows = rows
+
+    def keys(self):
+        return [col[0] for col in self.cursor.description]
+
+    def partitions(self, size):
+        for start in range(0, len(self.rows), size):
+            yield self.rows[start:start + size]
+        self.cursor = None
+
+
+def test_stream_parquet_types():
+    description = [("id", 23), ("value", 701), ("depth", 1700), ("time", 1114), ("gamma", 1022),
+                   ("bands", 1007), ("coords", 16400)]
+    rows = [
+        (1, 0.5, Decimal("1.25"), datetime(2021, 6, 1, 10, 30), [0.1, 0.2], [1, 2], "0101000020BB0B0000"),
+        (2, None, None, None, None, None, None),
+        (3, 2.0, Decimal("3"), datetime(2022, 1, 2), [], [3], "0101000020BB0B0001"),
+    ]
+    data = b"".join(exporters.stream_parquet(PostgresResult(description, rows), batch_size=2))
+    table = pq.read_table(io.BytesIO(data))
+    assert table.schema == pa.schema([("id", pa.int64()), ("value", pa.float64()), ("depth", pa.float64()),
+                                      ("time", pa.timestamp("us")), ("gamma", pa.list_(pa.float64())),
+                                      ("bands", pa.list_(pa.int64())), ("coords", pa.string())])
+    assert table.to_pylist() == [
+        {"id": 1, "value": 0.5, "depth": 1.25, "time": datetime(2021, 6, 1, 10, 30), "gamma": [0.1, 0.2],
+         "bands": [1, 2], "coords": "0101000020BB0B0000"},
+        {"id": 2, "value": None, "depth": None, "time": None, "gamma": None, "bands": None, "coords": None},
+        {"id": 3, "value": 2.0, "depth": 3.0, "time": datetime(2022, 1, 2), "gamma": [], "bands": [3],
+         "coords": "0101000020BB0B0001"},
+    ]
@@ -0,0 +1,76 @@
+import io
+import os
+import time
+import importlib.util
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+# the module is loaded on its own, importing the pignoletto package connects to the database
+spec = importlib.util.spec_from_file_location(
+    "readers", os.path.join(os.path.dirname(__file__), "..", "pignoletto", "readers.py"))
+readers = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(readers)
+
+
+def test_parse_pg_arrays():
+    literals, valid = readers.parse_pg_arrays(pd.Series(["[0.1, 2e-3]", "1,-2,+.5", "[]", "[1,,2]", "[1, abc]"]))
+    assert valid.tolist() == [True, True, False, False, False]
+    assert literals.tolist()[:2] == ["{0.1,2e-3}", "{1,-2,+.5}"]
+    assert literals[2:].isna().all()
+
+
+def test_parse_pg_arrays_lists():
+    literals, valid = readers.parse_pg_arrays(pd.Series([[1.0, 2.5], np.array([3.0]), [1.0, np.nan]]))
+    assert valid.tolist() == [True, True, False]
+    assert literals.tolist()[:2] == ["{1,2.5}", "{3}"]
+
+
+def test_parse_pg_arrays_rejects_bad_token_quickly():
+    # long integer lists with a bad token or a missing bracket used to backtrack exponentially
+    integers = ",".join(str(10000 + i) for i in range(200))
+    texts = [f"[{integers},nan]", f"[{integers}", f"{integers}x", f"[{integers}] x"]
+    start = time.perf_counter()
+    literals, valid = readers.parse_pg_arrays(pd.Series(texts))
+    assert time.perf_counter() - start < 1
+    assert not valid.any()
+    assert literals.isna().all()
+
+
+def test_parse_float_list():
+    assert readers.parse_float_list("[0.1, 2e-3, -4]").tolist() == [0.1, 0.002, -4.0]
+    assert readers.parse_float_list("1,2").tolist() == [1.0, 2.0]
+    for text in ("[1,nan]", "[]", "[1,2", "1;2"):
+        assert readers.parse_float_list(text) is None
+
+
+def gamma_table():
+    return pa.table({"id": [1, 2, 3], "gamma": pa.array([[0.1, 0.2], None, [3.0]], type=pa.list_(pa.float64()))})
+
+
+def check_gamma_chunks(chunks):
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+    gamma = pd.concat(chunks, ignore_index=True)["gamma"]
+    assert isinstance(gamma[0], np.ndarray)
+    literals, valid = readers.parse_pg_arrays(gamma)
+    assert valid.tolist() == [True, False, True]
+    assert literals[0] == "{0.10000000000000001,0.20000000000000001}"
+    assert literals[2] == "{3}"
+
+
+def test_read_columnar_chunks_parquet():
+    buffer = io.BytesIO()
+    pq.write_table(gamma_table(), buffer)
+    buffer.seek(0)
+    check_gamma_chunks(list(readers.read_columnar_chunks(buffer, "parquet", chunk_size=2)))
+
+
+def test_read_columnar_chunks_arrow():
+    buffer = io.BytesIO()
+    with pa.ipc.new_file(buffer, gamma_table().schema) as writer:
+        writer.write_table(gamma_table())
+    buffer.seek(0)
+    check_gamma_chunks(list(readers.read_columnar_chunks(buffer, "arrow", chunk_size=2)))